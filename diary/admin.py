@@ -7,7 +7,9 @@ from datetimewidget.widgets import DateWidget
 
 # Register your models here.
 
-from .models import Customer, Treatment, Resource, Entry
+from .models import (
+    Customer, Treatment, Resource, Entry, HistoricEntry, OutboundEmail,
+)
 
 # crispy forms
 from crispy_forms.helper import FormHelper
@@ -310,3 +312,53 @@ class EntryAdmin(admin.ModelAdmin):
        }),
     )
     ordering = ('date', 'time', )
+
+
+@admin.register(HistoricEntry)
+class HistoricEntryAdmin(admin.ModelAdmin):
+    list_display = [
+        'creator',
+        'date',
+        'time',
+        'customer',
+    ]
+    list_filter = [
+        'creator',
+        'customer',
+        'date',
+    ]
+    ordering = ('date', 'time', )
+
+
+    def has_add_permission(self, request):
+        return False
+
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = [
+        'subject',
+        'recipients',
+        'created',
+        'attempts',
+        'next_attempt',
+        'sent',
+    ]
+    list_filter = [
+        'sent',
+        'attempts',
+    ]
+    ordering = ('-created', )
+
+
+    def has_add_permission(self, request):
+        return False
+
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class DiaryConfig(AppConfig):
+    name = 'diary'
+
+
+    def ready(self):
+        """
+        Connect the signal handlers.
+        """
+        from . import signals
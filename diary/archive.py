@@ -0,0 +1,232 @@
+"""
+Archives of old diary entries.
+
+An archive is a gzip-compressed JSON Lines file with one entry per line. The
+entry's customer, treatment and resource are written out in full alongside
+it, so a record still makes sense if they have since been deleted. Each run
+of clean_entries --archive appends a new gzip member, which gzip readers
+see as one continuous file.
+"""
+import datetime
+import gzip
+import itertools
+import json
+import os
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .models import (
+    Entry, HistoricEntry, Customer, Treatment, Resource, endTime,
+)
+from . import caching
+from . import historic
+
+
+
+def entryRecord(entry):
+    """
+    An entry as a dictionary ready for JSON, with its relations written out.
+    """
+    customer = entry.customer
+    treatment = entry.treatment
+    resource = entry.resource
+    return {
+        'pk': entry.pk,
+        'date': entry.date.isoformat(),
+        'time': entry.time.isoformat(),
+        'duration': entry.duration.isoformat(),
+        'end_time': entry.end_time.isoformat(),
+        'notes': entry.notes,
+        'cancelled': entry.cancelled,
+        'no_show': entry.no_show,
+        'version': entry.version,
+        'created': entry.created.isoformat(),
+        'edited': entry.edited.isoformat(),
+        'creator': entry.creator.username if entry.creator else None,
+        'editor': entry.editor.username if entry.editor else None,
+        'customer': {
+            'pk': customer.pk,
+            'username': customer.username,
+            'title': customer.title,
+            'first_name': customer.first_name,
+            'last_name': customer.last_name,
+            'email': customer.email,
+            'phone': customer.phone,
+        } if customer else None,
+        'treatment': {
+            'name': treatment.name,
+            'min_duration': treatment.min_duration.total_seconds()
+                if treatment.min_duration is not None else None,
+            'resource_required': treatment.resource_required,
+        } if treatment else None,
+        'resource': {
+            'name': resource.name,
+            'description': resource.description,
+        } if resource else None,
+    }
+
+
+def archived(entries):
+    """
+    The entries with everything needed for their records.
+    """
+    return entries.select_related(
+        'customer',
+        'treatment',
+        'resource',
+        'creator',
+        'editor',
+    ).order_by('pk')
+
+
+def append(archive, entries):
+    """
+    Append the records of the entries to an open archive, and make sure they
+    are on disk before returning.
+    """
+    for entry in entries:
+        archive.write(json.dumps(entryRecord(entry)).encode() + b'\n')
+    archive.flush()
+    os.fsync(archive.fileobj.fileno())
+
+
+def open_archive(path):
+    """
+    Open an archive for appending.
+    """
+    return gzip.open(path, 'ab')
+
+
+def records(path):
+    """
+    Stream the records from an archive.
+    """
+    with gzip.open(path, 'rt') as archive:
+        for line in archive:
+            if line.strip():
+                yield json.loads(line)
+
+
+def restoredEntry(record, related):
+    """
+    An unsaved Entry for an archived record, with its relations matched by
+    key. related caches the lookups by (model, key) across records.
+
+    Customers must match on both primary key and username, and are left out
+    if no longer on the system; treatments and resources are matched by name
+    and recreated if need be.
+    """
+
+    def lookup(model, name, create):
+        key = (model, name)
+        if key not in related:
+            related[key] = create()
+        return related[key]
+
+    def customer():
+        return Customer.objects.filter(
+            pk=record['customer']['pk'],
+            username=record['customer']['username'],
+        ).first()
+
+    def treatment():
+        data = record['treatment']
+        minDuration = data['min_duration']
+        return Treatment.objects.filter(name=data['name']).first() or \
+            Treatment.objects.create(
+                name=data['name'],
+                min_duration=datetime.timedelta(seconds=minDuration or 0),
+                resource_required=data['resource_required'],
+            )
+
+    def resource():
+        data = record['resource']
+        return Resource.objects.filter(name=data['name']).first() or \
+            Resource.objects.create(
+                name=data['name'],
+                description=data['description'],
+                enabled=False,  # only needed for history
+            )
+
+    entry = Entry(
+        pk=record['pk'],
+        date=datetime.date.fromisoformat(record['date']),
+        time=datetime.time.fromisoformat(record['time']),
+        duration=datetime.time.fromisoformat(record['duration']),
+        notes=record['notes'],
+        cancelled=record['cancelled'],
+        no_show=record['no_show'],
+        version=record['version'],
+        created=datetime.datetime.fromisoformat(record['created']),
+        edited=datetime.datetime.fromisoformat(record['edited']),
+    )
+    entry.end_time = endTime(entry.time, entry.duration)
+    if record['customer']:
+        entry.customer = lookup(Customer, record['customer']['pk'], customer)
+    if record['treatment']:
+        entry.treatment = lookup(
+            Treatment, record['treatment']['name'], treatment,
+        )
+    if record['resource']:
+        entry.resource = lookup(Resource, record['resource']['name'], resource)
+    for field in ('creator', 'editor'):
+        username = record[field]
+        if username:
+            setattr(entry, field, lookup(
+                User,
+                username,
+                lambda: User.objects.filter(username=username).first(),
+            ))
+    return entry
+
+
+def restore(path, chunk, before=None):
+    """
+    Re-import the entries from an archive in chunks, skipping any already in
+    the diary or in cold storage. Entries dated before the date before, if
+    given, are restored straight into cold storage. Returns the numbers of
+    entries restored and skipped.
+
+    Restored entries are historic, so they are written directly rather than
+    through the booking rules in Entry.save(). The created and edited times
+    of those restored to the Entry table, which the insert sets to now, are
+    written back afterwards.
+    """
+    restored = skipped = 0
+    related = {}
+    batch = []
+    for record in itertools.chain(records(path), [None]):
+        if record is not None:
+            batch.append(restoredEntry(record, related))
+        if batch and (record is None or len(batch) == chunk):
+            pks = [entry.pk for entry in batch]
+            with transaction.atomic():
+                existing = set()
+                for model in (Entry, HistoricEntry):
+                    existing.update(model.objects.filter(
+                        pk__in=pks,
+                    ).values_list('pk', flat=True))
+                new = [entry for entry in batch if entry.pk not in existing]
+                cold, recent = [], []
+                for entry in new:
+                    if before is not None and entry.date < before:
+                        cold.append(entry)
+                    else:
+                        recent.append(entry)
+                HistoricEntry.objects.bulk_create([
+                    HistoricEntry(**{
+                        field: getattr(entry, field)
+                        for field in historic.FIELDS
+                    })
+                    for entry in cold
+                ])
+                stamps = [(entry.created, entry.edited) for entry in recent]
+                Entry.objects.bulk_create(recent)
+                for entry, (created, edited) in zip(recent, stamps):
+                    entry.created, entry.edited = created, edited
+                Entry.objects.bulk_update(recent, ['created', 'edited'])
+            caching.invalidate_occupancy(*{entry.date for entry in new})
+            restored += len(new)
+            skipped += len(existing)
+            batch = []
+    return restored, skipped
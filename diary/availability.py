@@ -0,0 +1,66 @@
+"""
+Availability search: where can a treatment fit in a range of dates?
+
+The bookings for the whole date range are fetched in one query and dealt into
+per-day occupancies. Each day is then swept once from opening to closing time,
+collecting the free windows long enough for the treatment.
+"""
+import collections
+import datetime
+
+from .intervals import Occupancy
+from .models import Resource
+from . import settings
+
+
+Window = collections.namedtuple('Window', 'date start end resource')
+
+
+
+def availability(treatment, start, end, customer=None, after=None):
+    """
+    The free windows in which the treatment could be booked, from start to end
+    dates inclusive, as a list of Window in date, resource and time order.
+
+    Windows lie within opening hours and are at least the treatment's minimum
+    duration. A treatment requiring a resource gets windows for each enabled
+    resource; otherwise the resource is None. If a customer is given, their
+    own bookings are kept clear too. If after (a datetime) is given, nothing
+    starts before it.
+    """
+    length = treatment.min_duration or datetime.timedelta(0)
+    if treatment.resource_required:
+        resources = list(Resource.objects.filter(enabled=True).order_by('name'))
+    else:
+        resources = [None]
+    if after is not None and after.date() > start:
+        start = after.date()
+
+    resourceOccupancy, customerOccupancy = Occupancy.for_range(
+        start,
+        end,
+        resources=[resource.pk for resource in resources if resource],
+        customer=customer,
+    )
+
+    windows = []
+    date = start
+    while date <= end:
+        opening = settings.DIARY_OPENING_TIMES[date.weekday()]
+        closing = settings.DIARY_CLOSING_TIMES[date.weekday()]
+        if after is not None and date == after.date():
+            opening = max(opening, after.time())
+        for resource in resources:
+            occupancy = customerOccupancy.get(date, Occupancy())
+            if resource:
+                occupancy = occupancy | resourceOccupancy.get(
+                    (resource.pk, date), Occupancy(),
+                )
+            windows.extend(
+                Window(date, windowStart, windowEnd, resource)
+                for windowStart, windowEnd in occupancy.free_windows(
+                    opening, closing, length,
+                )
+            )
+        date += datetime.timedelta(days=1)
+    return windows
@@ -0,0 +1,146 @@
+"""
+Cached diary data and its invalidation.
+
+The cached values are kept fresh by the Entry signal handlers in signals.py,
+with a timeout as a backstop for changes that bypass the signals (such as
+queryset updates). The invalidation only reaches every process if they share
+the cache, so a multi-process deployment needs a shared cache backend.
+"""
+import datetime
+import random
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Entry, HistoricEntry
+from . import settings
+
+
+OCCUPANCY_KEY = 'diary:occupancy:{0}'
+REMINDERS_KEY = 'diary:reminders:{0}'
+REMINDERS_GENERATION_KEY = 'diary:reminders:generation'
+
+
+
+def occupancy(first_year, last_year):
+    """
+    Obtain the months that have any entries in a range of years.
+
+    Returns a dictionary keyed by year of 12-bit month bitmaps, where bit n is
+    set if month n+1 has entries. Each year is cached separately, and any years
+    not found in the cache are evaluated together in one query each on recent
+    and historic entries.
+    """
+    years = range(first_year, last_year+1)
+    cached = cache.get_many([OCCUPANCY_KEY.format(year) for year in years])
+    bitmaps = {
+        year: cached[OCCUPANCY_KEY.format(year)]
+        for year in years if OCCUPANCY_KEY.format(year) in cached
+    }
+
+    missing = [year for year in years if year not in bitmaps]
+    if missing:
+        found = {year: 0 for year in missing}
+        for model in (Entry, HistoricEntry):    # recent and historic entries
+            for month in model.objects.filter(
+                date__gte=datetime.date(missing[0], 1, 1),
+                date__lt=datetime.date(missing[-1]+1, 1, 1),
+            ).dates('date', 'month'):
+                if month.year in found:
+                    found[month.year] |= 1 << (month.month-1)
+        cache.set_many(
+            {OCCUPANCY_KEY.format(year): bitmap
+                for year, bitmap in found.items()},
+            settings.DIARY_CACHE_TIMEOUT,
+        )
+        bitmaps.update(found)
+
+    return bitmaps
+
+
+def invalidate_occupancy(*dates):
+    """
+    Discard the cached occupancy for the years of the given dates.
+    """
+    cache.delete_many(
+        {OCCUPANCY_KEY.format(date.year) for date in dates if date}
+    )
+
+
+def reminders_generation():
+    """
+    A random starting generation for the reminders, so that if the generation
+    key is evicted, cached reminders from before can't match it again.
+    """
+    return random.getrandbits(62)
+
+
+def reminders(user):
+    """
+    Obtain the upcoming entries for the reminder sidebar.
+
+    Staff see everybody's entries, customers only their own. The entries are
+    cached per user until one of them starts, the day changes, or an entry for
+    today or tomorrow is changed. A cache hit costs one cache round trip.
+    """
+    tz_now = timezone.localtime(timezone.now())
+    today, now = tz_now.date(), tz_now.time()
+    user_key = REMINDERS_KEY.format('staff' if user.is_staff else user.pk)
+
+    cached = cache.get_many([REMINDERS_GENERATION_KEY, user_key])
+    generation = cached.get(REMINDERS_GENERATION_KEY)
+    if generation is None:
+        # seed the generation, unless another process got there first
+        cache.add(REMINDERS_GENERATION_KEY, reminders_generation(), None)
+        generation = cache.get(REMINDERS_GENERATION_KEY)
+    payload = cached.get(user_key)
+    if (
+        payload and
+        payload['generation'] == generation and
+        (today, now) <= payload['valid_until']
+    ):
+        return payload['entries']
+
+    tomorrow = today + datetime.timedelta(days=1)
+    entries = Entry.objects.filter(
+        Q(date=today, time__gte=now)|Q(date=tomorrow),
+        cancelled=False,
+    )
+    if not user.is_staff:               # customers only see their own entries
+        entries = entries.filter(customer_id=user.pk)
+    entries = list(
+        entries.select_related(
+            'customer',
+            'treatment',
+            'resource',
+        ).order_by('date', 'time')
+    )
+
+    # the first of today's entries drops off the list once it has started
+    valid_until = (today, datetime.time.max)
+    if entries and entries[0].date == today:
+        valid_until = (today, entries[0].time)
+
+    cache.set(
+        user_key,
+        {
+            'generation': generation,
+            'valid_until': valid_until,
+            'entries': entries,
+        },
+        settings.DIARY_CACHE_TIMEOUT,
+    )
+    return entries
+
+
+def invalidate_reminders(*dates):
+    """
+    Discard all cached reminders if any of the dates is today or tomorrow.
+    """
+    today = timezone.localtime(timezone.now()).date()
+    tomorrow = today + datetime.timedelta(days=1)
+    if today in dates or tomorrow in dates:
+        try:
+            cache.incr(REMINDERS_GENERATION_KEY)
+        except ValueError:              # no generation, or evicted
+            cache.set(REMINDERS_GENERATION_KEY, reminders_generation(), None)
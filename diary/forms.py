@@ -53,6 +53,20 @@ class EntryForm(forms.ModelForm):
         # configure resource selection list to exclude disabled resources
         self.fields['resource'].queryset = Resource.objects.filter(enabled=True)
 
+        # the version read is posted back to detect changes made meanwhile
+        self.fields['version'].required = False
+
+
+    def clean_version(self):
+        """
+        The version the entry was read at, or the version just loaded if none
+        was posted, in which case changes made meanwhile go undetected.
+        """
+        version = self.cleaned_data.get('version')
+        if version is None:
+            version = self.instance.version
+        return version
+
 
     class Meta:
         model = Entry
@@ -64,8 +78,10 @@ class EntryForm(forms.ModelForm):
             'duration',
             'resource',
             'notes',
+            'version',
         )
         widgets = {
+            'version': forms.HiddenInput(),
             # override customer widget attributes AFTER creating the form
             'customer': RelatedFieldWidgetCanAdd(Customer),
             'date': DateWidget(
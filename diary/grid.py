@@ -0,0 +1,159 @@
+"""
+The diary grid: entries for a range of dates laid out in time slots.
+
+This is the common engine for the calendar-style diary views (day, multi-day
+and any future week view). A grid is built with a fixed number of database
+queries however many days and time slots it covers.
+"""
+import datetime
+from django.utils import timezone
+
+from .models import Entry
+from . import settings
+
+
+
+def evaluateBusinessLogic(day, startTime, endTime, today=None, now=None):
+    """
+    Evaluate the booleans that control the display business logic for day and
+    multi-day views.
+
+    The current date and time may be supplied to avoid re-evaluating them for
+    every cell of a grid.
+    """
+    if today is None or now is None:
+        tz_now = timezone.localtime(timezone.now())
+        today, now = tz_now.date(), tz_now.time()
+    current = ((now >= startTime and now < endTime) and day == today)
+    trading = (
+        startTime >= settings.DIARY_OPENING_TIMES[day.weekday()] and
+        endTime <= settings.DIARY_CLOSING_TIMES[day.weekday()]
+    ) # trading time
+    historic = (
+        day < today or (day == today and endTime < now)
+    ) # historic data
+    booking_allowed_date = (today +
+        datetime.timedelta(days=settings.DIARY_MIN_BOOKING)
+    )
+    before_advance = day < booking_allowed_date
+    allow_dnd = trading and not (historic or before_advance)
+    return current, trading, historic, before_advance, allow_dnd
+
+
+
+class GridCell(object):
+    """
+    One time slot on one date of the diary grid.
+    """
+
+
+    def __init__(self, date, timeSlot, entries, flags):
+        self.date = date
+        self.timeSlot = timeSlot
+        self.entries = entries
+        (
+            self.current,
+            self.trading,
+            self.historic,
+            self.before_advance,
+            self.allow_dnd,
+        ) = flags
+
+
+
+class DiaryGrid(object):
+    """
+    The entries for a run of consecutive dates divided into time slots.
+
+    timeSlots is a sequence of (label, slug, start time, end time) tuples in
+    time order, as produced by views.evaluateTimeSlots(). The grid has one row
+    per time slot and one column per date. Each cell holds the entries starting
+    in its time slot, plus the business logic flags for the cell.
+
+    The whole date range is fetched in one ordered query and the entries are
+    dealt into the cells in a single pass. Entries falling outside the time
+    slots are not displayed. For users who are not staff, no-show entries are
+    left out altogether as they are never displayed to them.
+    """
+
+
+    def __init__(self, start, days, timeSlots, user):
+        self.dates = [start + datetime.timedelta(days=n) for n in range(days)]
+        self.timeSlots = timeSlots
+        self.user = user
+        self.rows = self.build()
+
+
+    def entries(self):
+        """
+        The queryset of entries covering the whole grid.
+        """
+        entries = Entry.objects.filter(
+            date__gte=self.dates[0],
+            date__lte=self.dates[-1],
+        )
+        if not self.user.is_staff:
+            entries = entries.exclude(no_show=True)
+        return entries.select_related(
+            'customer',
+            'resource',
+            'treatment',
+        ).order_by('date', 'time')
+
+
+    def bucket(self):
+        """
+        Deal the entries into lists for each time slot (rows) and date (cols).
+        """
+        timeSlots = self.timeSlots
+        buckets = [[[] for day in self.dates] for slot in timeSlots]
+        if not self.dates or not timeSlots:
+            return buckets
+
+        # entries arrive in date/time order so the slot index only moves
+        # forward until the date changes
+        currentDate = None
+        col = row = 0
+        for entry in self.entries():
+            if entry.date != currentDate:
+                currentDate = entry.date
+                col = (entry.date - self.dates[0]).days
+                row = 0
+            while row < len(timeSlots) and entry.time >= timeSlots[row][3]:
+                row += 1
+            if row == len(timeSlots):
+                continue                    # after the last time slot
+            if entry.time < timeSlots[row][2]:
+                continue                    # before the first time slot
+            buckets[row][col].append(entry)
+        return buckets
+
+
+    def build(self):
+        """
+        Populate the grid cells with entries and business logic flags.
+        """
+        tz_now = timezone.localtime(timezone.now())
+        today, now = tz_now.date(), tz_now.time()
+        rows = []
+        for timeSlot, rowEntries in zip(self.timeSlots, self.bucket()):
+            label, slug, startTime, endTime = timeSlot
+            rows.append((
+                timeSlot,
+                [
+                    GridCell(
+                        day,
+                        timeSlot,
+                        entries,
+                        evaluateBusinessLogic(
+                            day, startTime, endTime, today, now,
+                        ),
+                    )
+                    for day, entries in zip(self.dates, rowEntries)
+                ],
+            ))
+        return rows
+
+
+    def __iter__(self):
+        return iter(self.rows)
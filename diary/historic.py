@@ -0,0 +1,109 @@
+"""
+Cold storage for historic entries.
+
+The move_historic_entries command moves old entries out of the Entry table
+into the HistoricEntry table in chunks, so that the queries behind the diary
+grids and booking validation only ever touch recent entries. A customer's
+history reads both tables, a page at a time.
+"""
+import itertools
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Entry, HistoricEntry
+from . import caching
+
+
+# the columns copied, the same in both tables
+FIELDS = [field.attname for field in HistoricEntry._meta.concrete_fields]
+
+
+
+def move(pks):
+    """
+    Move the entries with the given primary keys into cold storage in one
+    transaction. Returns the number moved.
+    """
+    with transaction.atomic():
+        rows = list(
+            Entry.objects.filter(pk__in=pks).select_for_update().values(*FIELDS)
+        )
+        HistoricEntry.objects.bulk_create(
+            [HistoricEntry(**row) for row in rows]
+        )
+        Entry.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+    caching.invalidate_occupancy(*{row['date'] for row in rows})
+    return len(rows)
+
+
+def move_historic(entries, chunk, progress=None):
+    """
+    Move the entries into cold storage a chunk at a time, calling progress,
+    if given, with the running total after each chunk. Returns the number
+    moved.
+    """
+    moved = 0
+    while True:
+        pks = list(
+            entries.order_by('pk').values_list('pk', flat=True)[:chunk]
+        )
+        if not pks:
+            break
+        moved += move(pks)
+        if progress:
+            progress(moved)
+    return moved
+
+
+def customer_querysets(customer, until):
+    """
+    Querysets of a customer's recent and historic entries up to and including
+    a date.
+    """
+    return [
+        model.objects.filter(customer=customer, date__lte=until)
+        for model in (Entry, HistoricEntry)
+    ]
+
+
+def entryKey(entry):
+    """
+    The (date, time, pk) key that orders a customer's history.
+    """
+    return (entry.date, entry.time, entry.pk)
+
+
+def keyedBefore(entries, key):
+    """
+    The entries ordered before the (date, time, pk) key.
+    """
+    date, time, pk = key
+    return entries.filter(
+        Q(date__lt=date) |
+        Q(date=date, time__lt=time) |
+        Q(date=date, time=time, pk__lt=pk)
+    )
+
+
+def customer_page(customer, until, size, before=None):
+    """
+    A page of at most size of a customer's entries up to and including a
+    date, from both recent and historic storage, most recent first. The page
+    starts after the (date, time, pk) key before, if given.
+
+    Returns the entries and the key to continue from, or None at the end.
+    Each table is read from its index for at most size + 1 entries, so a
+    page costs the same however long the history.
+    """
+    pages = []
+    for entries in customer_querysets(customer, until):
+        if before:
+            entries = keyedBefore(entries, before)
+        pages.append(
+            entries.select_related('treatment').order_by(
+                '-date', '-time', '-pk',
+            )[:size + 1]
+        )
+    merged = sorted(itertools.chain(*pages), key=entryKey, reverse=True)
+    page = merged[:size]
+    return page, entryKey(page[-1]) if len(merged) > size else None
@@ -0,0 +1,191 @@
+"""
+Occupancy of diary resources and customers as sorted intervals.
+
+An Occupancy holds the busy periods of one resource (or customer) on one day,
+merged into disjoint blocks in time order. Gap searches start from a binary
+search, so a day can be probed many times for the cost of the one query that
+built it.
+"""
+import bisect
+import collections
+import datetime
+from django.db.models import Q
+
+from .models import Entry, durationDelta
+
+
+TIME_MAX = durationDelta(datetime.time.max)
+
+
+
+def toDelta(time):
+    """
+    Convert a time of day to a delta since midnight.
+    """
+    return durationDelta(time)
+
+
+def toTime(delta):
+    """
+    Convert a delta since midnight to a time of day.
+    """
+    return (datetime.datetime.min + min(delta, TIME_MAX)).time()
+
+
+
+class Occupancy(object):
+    """
+    The busy periods of a resource or customer on one day.
+
+    Periods are (start, end) pairs of times, with non-inclusive ends as for
+    Entry.__eq__(). Touching and overlapping periods are merged.
+    """
+
+
+    def __init__(self, periods=()):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(
+            (toDelta(start), toDelta(end)) for start, end in periods
+        ):
+            if self.starts and start < self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            elif self.starts and start == self.ends[-1] and start != end:
+                self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+
+    @classmethod
+    def bookings(cls):
+        """
+        The entries that occupy time: cancellations and no-shows don't count.
+        """
+        return Entry.objects.filter(cancelled=False, no_show=False)
+
+
+    @classmethod
+    def for_day(cls, date, resource=None, customer=None, exclude=None):
+        """
+        Build the occupancy of a resource and/or a customer on a day from one
+        query. With both, a period is busy if either of them is booked.
+
+        exclude is an entry to leave out, typically one being moved.
+        """
+        entries = cls.bookings().filter(date=date)
+        if resource and customer:
+            entries = entries.filter(
+                Q(resource=resource) | Q(customer=customer)
+            )
+        elif resource:
+            entries = entries.filter(resource=resource)
+        elif customer:
+            entries = entries.filter(customer=customer)
+        if exclude is not None and exclude.pk:
+            entries = entries.exclude(pk=exclude.pk)
+        return cls(entries.values_list('time', 'end_time'))
+
+
+    @classmethod
+    def for_range(cls, start, end, resources=None, customer=None):
+        """
+        Build the occupancies of resources and a customer for a range of dates
+        from one query.
+
+        resources is an iterable of resource ids, or None for every resource.
+        Returns a dictionary of Occupancy keyed by (resource id, date), and
+        one of the customer's Occupancy keyed by date. Days with no bookings
+        are absent.
+        """
+        resourceIds = None if resources is None else set(resources)
+        if resourceIds is not None and not resourceIds and customer is None:
+            return {}, {}
+        wanted = (
+            Q(resource_id__isnull=False) if resourceIds is None
+            else Q(resource_id__in=resourceIds)
+        )
+        if customer is not None:
+            wanted |= Q(customer_id=customer.pk)
+
+        resourcePeriods = collections.defaultdict(list)
+        customerPeriods = collections.defaultdict(list)
+        for resource_id, customer_id, date, time, end_time in cls.bookings(
+        ).filter(
+            wanted,
+            date__gte=start,
+            date__lte=end,
+        ).values_list('resource_id', 'customer_id', 'date', 'time', 'end_time'):
+            if resource_id is not None and (
+                resourceIds is None or resource_id in resourceIds
+            ):
+                resourcePeriods[(resource_id, date)].append((time, end_time))
+            if customer is not None and customer_id == customer.pk:
+                customerPeriods[date].append((time, end_time))
+        return (
+            {pair: cls(periods) for pair, periods in resourcePeriods.items()},
+            {date: cls(periods) for date, periods in customerPeriods.items()},
+        )
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def blocks(self):
+        """
+        The merged busy periods as (start, end) times.
+        """
+        return [
+            (toTime(start), toTime(end))
+            for start, end in zip(self.starts, self.ends)
+        ]
+
+
+    def __or__(self, other):
+        """
+        The occupancy busy whenever either occupancy is.
+        """
+        return Occupancy(self.blocks() + other.blocks())
+
+
+    def next_gap(self, after, length, until=datetime.time.max):
+        """
+        The earliest start time at or after 'after' for a free period of the
+        given length (a timedelta) ending by 'until', or None if there is none.
+        """
+        candidate = toDelta(after)
+        until = toDelta(until)
+        i = bisect.bisect_right(self.starts, candidate)
+        if i and self.ends[i-1] > candidate:
+            candidate = self.ends[i-1]
+        elif i and self.starts[i-1] == candidate:
+            candidate = max(candidate, self.ends[i-1])
+        while i < len(self.starts) and candidate + length > self.starts[i]:
+            candidate = max(candidate, self.ends[i])
+            i += 1
+        if candidate + length > until:
+            return None
+        return toTime(candidate)
+
+
+    def free_windows(self, opening, closing, length=datetime.timedelta(0)):
+        """
+        The free periods between opening and closing times at least as long
+        as length, as (start, end) times.
+        """
+        opening, closing = toDelta(opening), toDelta(closing)
+        windows = []
+        candidate = opening
+        i = bisect.bisect_right(self.ends, opening)
+        while candidate < closing:
+            if i < len(self.starts):
+                blockStart, blockEnd = self.starts[i], self.ends[i]
+            else:
+                blockStart = blockEnd = closing
+            gapEnd = min(blockStart, closing)
+            if gapEnd > candidate and gapEnd - candidate >= length:
+                windows.append((toTime(candidate), toTime(gapEnd)))
+            candidate = max(candidate, blockEnd)
+            i += 1
+        return windows
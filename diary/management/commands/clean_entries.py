@@ -1,12 +1,22 @@
 from django.core.management.base import BaseCommand, CommandError
-from diary.models import Entry, Customer
-from diary.views import get_today_now
+from django.db import transaction
+from diary.models import Entry, HistoricEntry, Customer, BookingLock
+from diary import archive
+from diary import outbox
+from django.utils import timezone
+from diary.views import get_today_now, yearsBefore
 import datetime
 
 
+# default number of entries deleted per transaction
+CHUNK_SIZE = 1000
+
+
 class Command(BaseCommand):
     """
-    Periodically clean out old database data in the Entry table.
+    Periodically clean out old database data in the Entry and HistoricEntry
+    tables, along with the booking locks and finished outbound emails of the
+    time.
     """
 
     help = "Clean old Entry data in the database."
@@ -17,6 +27,10 @@ class Command(BaseCommand):
         Define the date before when to delete entries either by
         -a --age      age of the entry (from the date of the appointment)
         -b --before   date before which to delete
+        and how
+        -c --chunk    number of entries deleted per transaction
+        -n --dry-run  count the entries but don't delete them
+        -z --archive  append the entries to a gzipped JSON Lines file first
         """
         parser.add_argument(
             '-a',
@@ -32,6 +46,25 @@ class Command(BaseCommand):
             type=datetime.date.fromisoformat,
             default=get_today_now()[0],
         )
+        parser.add_argument(
+            '-c',
+            '--chunk',
+            help="entries per transaction",
+            type=int,
+            default=CHUNK_SIZE,
+        )
+        parser.add_argument(
+            '-n',
+            '--dry-run',
+            help="count only",
+            action='store_true',
+        )
+        parser.add_argument(
+            '-z',
+            '--archive',
+            help="archive file (.jsonl.gz)",
+            default=None,
+        )
 
 
     def handle(self, *args, **kwargs):
@@ -46,19 +79,72 @@ class Command(BaseCommand):
 
         # override before date with date calculated from age
         if age > 0:
-            before = today.replace(year=today.year-age)
+            before = yearsBefore(today, age)
 
         # ensure the date being asked for is sane
         if not before or before >= today:
             raise CommandError("Specify a valid before date (-b) or an age (-a).")
 
-        # delete entries before the selected date
+        # count the entries before the selected date in the database, recent
+        # and historic
         entries = Entry.objects.filter(date__lt=before,)
-        n = len(entries)
+        historic = HistoricEntry.objects.filter(date__lt=before,)
+        n = entries.values('pk').union(historic.values('pk'), all=True).count()
         name = 'entry' if n==1 else 'entries'   # pluralisation
+        verb = 'Would clean' if kwargs['dry_run'] else 'Cleaning'
         if kwargs['age']:
-            print(f"Cleaning {n} {name} older than {age} years ... ", end='')
+            print(f"{verb} {n} {name} older than {age} years ... ", end='')
         else:
-            print(f"Cleaning {n} {name} prior to {before} ... ", end='')
-        entries.delete()
+            print(f"{verb} {n} {name} prior to {before} ... ", end='')
+        if kwargs['dry_run']:
+            print("Done")
+            return
+
+        # delete them in primary key ranges, a chunk per transaction, after
+        # archiving them if asked
+        chunk = max(kwargs['chunk'], 1)
+        archive_file = None
+        if kwargs['archive']:
+            archive_file = archive.open_archive(kwargs['archive'])
+        try:
+            deleted = self.delete_chunks(historic, n, chunk, archive_file)
+            self.delete_chunks(entries, n, chunk, archive_file, deleted)
+        finally:
+            if archive_file:
+                archive_file.close()
+        BookingLock.objects.filter(date__lt=before).delete()
+        outbox.purge(timezone.make_aware(
+            datetime.datetime.combine(before, datetime.time.min),
+        ))
         print("Done")
+
+
+    def delete_chunks(self, entries, n, chunk, archive_file=None, deleted=0):
+        """
+        Delete the entries in primary key ranges of chunk entries, each in its
+        own transaction, reporting progress towards n from those already
+        deleted. Each chunk is first appended to the archive file, if any.
+        Returns the running total deleted.
+        """
+        last_pk = 0
+        while deleted < n:
+            remaining = entries.filter(pk__gt=last_pk)
+            upper = remaining.order_by('pk').values_list('pk', flat=True)[
+                chunk-1:chunk
+            ].first()
+            if upper is None:
+                # the last chunk
+                upper = remaining.order_by('-pk').values_list(
+                    'pk', flat=True,
+                ).first()
+                if upper is None:
+                    break
+            with transaction.atomic():
+                doomed = remaining.filter(pk__lte=upper)
+                if archive_file:
+                    archive.append(archive_file, archive.archived(doomed))
+                count, counts = doomed.delete()
+            deleted += counts.get(entries.model._meta.label, 0)
+            last_pk = upper
+            print(f"{deleted}/{n} ... ", end='', flush=True)
+        return deleted
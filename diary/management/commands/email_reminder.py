@@ -1,11 +1,7 @@
 from django.core.management.base import BaseCommand, CommandError
-from diary.models import Entry, Customer
 from diary.views import get_today_now
+from diary.reminders import remind
 import datetime
-from django.core import mail
-from django.template.loader import render_to_string
-from django.template import Context
-from django.conf import settings as main_settings
 from diary import settings as settings
 
 
@@ -16,68 +12,44 @@ class Command(BaseCommand):
     """
 
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
         """
-        Handler to prepare and submit the emails.
+        Define the batching and parallelism of the mail-out
+        -b --batch      number of reminders per batch
+        -w --workers    number of threads rendering reminders
         """
+        parser.add_argument(
+            '-b',
+            '--batch',
+            help="reminders per batch",
+            type=int,
+            default=settings.DIARY_EMAIL_BATCH,
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            help="rendering threads",
+            type=int,
+            default=settings.DIARY_EMAIL_WORKERS,
+        )
 
-        # select the entries that qualify for reminders
-        # TODO: currently hard-coded to remind the day before
-        today, now = get_today_now()
-        tomorrow = today + datetime.timedelta(days=1)
-        entries = Entry.objects.filter(
-            date=tomorrow,
-            cancelled=False, # reminders not needed for cancelled entries
-            customer__email__gt='', # test for non-blank (not non-null) email
-            customer__opt_out_entry_reminder_email=False, # customer wants reminders
-        ).order_by('time')
-
-        # collect summary info for site admins
-        n_emails = entries.count()
-        summary = []
-        for entry in entries:
-            summary.append(
-                '{0} <{1}>: {2} {3}:  {4}'.format(
-                    entry.customer,
-                    entry.customer.email,
-                    entry.date,
-                    entry.time,
-                    entry.treatment,
-                )
-            )
 
-        # prepare the messages
-        reminder_messages = []
-        for entry in entries:
-            message = (
-                settings.DIARY_SITE_NAME+': Appointment Reminder',
-                render_to_string(
-                    'diary/email_reminder.txt',
-                    context={
-                        'entry': entry,
-                        'site_name': settings.DIARY_SITE_NAME,
-                        'contact_email': main_settings.DEFAULT_FROM_EMAIL,
-                        'contact_phone': settings.DIARY_CONTACT_PHONE,
-                    },
-                ),
-                main_settings.DEFAULT_FROM_EMAIL,
-                [entry.customer.email],
-            )
-            reminder_messages.append(message)
+    def handle(self, *args, **kwargs):
+        """
+        Handler to prepare and submit the emails.
 
-        # add a message to notify site admins
-        admin_message = 'Reminders sent to {0} customers:\n\n'.format(n_emails)
-        admin_message += '\n'.join(summary)
-        reminder_messages.append(
-            (
-                settings.DIARY_SITE_NAME +
-                    ': Reminders Summary for {0} at {1}'.format(today, now),
-                admin_message,
-                main_settings.SERVER_EMAIL,
-                [email for name, email in main_settings.ADMINS],
-            )
+        Each reminder rule sends reminders for the entries that have entered
+        its window since they were last reminded, so the command can run as
+        often as you like without sending anything twice.
+        """
+        today, now = get_today_now()
+        sent, failed = remind(
+            datetime.datetime.combine(today, now),
+            batch_size=kwargs['batch'],
+            workers=kwargs['workers'],
         )
-
-        # send the messages
-        mail.send_mass_mail(reminder_messages, fail_silently=False)
-        print('Reminder messages sent: {0}'.format(len(reminder_messages)))
+        if sent or failed:
+            print('Reminder messages sent: {0}, failed: {1}'.format(
+                len(sent) + 1,
+                len(failed),
+            ))
@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand, CommandError
+from diary.models import Entry
+from diary.historic import move_historic
+from diary.views import get_today_now, yearsBefore
+import datetime
+
+
+# default number of entries moved per transaction
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    """
+    Periodically move old entries from the Entry table into cold storage.
+    """
+
+    help = "Move old Entry data into the HistoricEntry table."
+
+
+    def add_arguments(self, parser):
+        """
+        Define the date before when to move entries either by
+        -a --age      age of the entry (from the date of the appointment)
+        -b --before   date before which to move
+        and how
+        -c --chunk    number of entries moved per transaction
+        -n --dry-run  count the entries but don't move them
+        """
+        parser.add_argument(
+            '-a',
+            '--age',
+            help="age in years",
+            type=int,
+            default=0,
+        )
+        parser.add_argument(
+            '-b',
+            '--before',
+            help="date HWM (yyyy-mm-dd)",
+            type=datetime.date.fromisoformat,
+            default=get_today_now()[0],
+        )
+        parser.add_argument(
+            '-c',
+            '--chunk',
+            help="entries per transaction",
+            type=int,
+            default=CHUNK_SIZE,
+        )
+        parser.add_argument(
+            '-n',
+            '--dry-run',
+            help="count only",
+            action='store_true',
+        )
+
+
+    def handle(self, *args, **kwargs):
+        """
+        Move the entries selected by the argument(s) provided.
+        """
+
+        today, now = get_today_now()
+
+        age = kwargs['age']
+        before = kwargs['before']
+
+        # override before date with date calculated from age
+        if age > 0:
+            before = yearsBefore(today, age)
+
+        # ensure the date being asked for is sane
+        if not before or before >= today:
+            raise CommandError("Specify a valid before date (-b) or an age (-a).")
+
+        # count the entries before the selected date in the database
+        entries = Entry.objects.filter(date__lt=before,)
+        n = entries.count()
+        name = 'entry' if n==1 else 'entries'   # pluralisation
+        verb = 'Would move' if kwargs['dry_run'] else 'Moving'
+        if kwargs['age']:
+            print(f"{verb} {n} {name} older than {age} years ... ", end='')
+        else:
+            print(f"{verb} {n} {name} prior to {before} ... ", end='')
+        if kwargs['dry_run']:
+            print("Done")
+            return
+
+        move_historic(
+            entries,
+            max(kwargs['chunk'], 1),
+            lambda moved: print(f"{moved}/{n} ... ", end='', flush=True),
+        )
+        print("Done")
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from diary import archive
+from diary import settings
+from diary.views import get_today_now, yearsBefore
+import datetime
+import os
+
+
+# default number of entries restored per transaction
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    """
+    Restore old entries archived by clean_entries --archive.
+    """
+
+    help = "Restore Entry data from a clean_entries archive."
+
+
+    def add_arguments(self, parser):
+        """
+        Define the archive to restore from
+        archive       the archive file (.jsonl.gz)
+        and how
+        -b --before   date before which to restore into cold storage, by
+                      default that implied by DIARY_HISTORIC_AGE
+        -c --chunk    number of entries restored per transaction
+        """
+        parser.add_argument(
+            'archive',
+            help="archive file (.jsonl.gz)",
+        )
+        parser.add_argument(
+            '-b',
+            '--before',
+            help="cold storage date HWM (yyyy-mm-dd)",
+            type=datetime.date.fromisoformat,
+            default=None,
+        )
+        parser.add_argument(
+            '-c',
+            '--chunk',
+            help="entries per transaction",
+            type=int,
+            default=CHUNK_SIZE,
+        )
+
+
+    def handle(self, *args, **kwargs):
+        """
+        Restore the archived entries not already in the diary, the older
+        ones into cold storage.
+        """
+        path = kwargs['archive']
+        if not os.path.isfile(path):
+            raise CommandError(f"No archive at {path}.")
+        before = kwargs['before']
+        if before is None and settings.DIARY_HISTORIC_AGE:
+            today, now = get_today_now()
+            before = yearsBefore(today, settings.DIARY_HISTORIC_AGE)
+        print(f"Restoring entries from {path} ... ", end='')
+        restored, skipped = archive.restore(
+            path,
+            max(kwargs['chunk'], 1),
+            before,
+        )
+        print(f"{restored} restored, {skipped} skipped ... Done")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from diary.scheduler import diary_scheduler
+
+
+class Command(BaseCommand):
+    """
+    Resident process running the diary's reminders, email queue and
+    cleaning as they fall due.
+    """
+
+    help = "Run the diary's scheduled work in one long-running process."
+
+
+    def add_arguments(self, parser):
+        """
+        Define how long to run
+        -c --cycles     stop after n wake-ups (default is to run for ever)
+        """
+        parser.add_argument(
+            '-c',
+            '--cycles',
+            help="number of wake-ups",
+            type=int,
+            default=None,
+        )
+
+
+    def handle(self, *args, **kwargs):
+        """
+        Run the scheduler until interrupted.
+        """
+        print("Diary scheduler running ... ")
+        try:
+            diary_scheduler().run(cycles=kwargs['cycles'])
+        except KeyboardInterrupt:
+            pass
+        print("Diary scheduler stopped")
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from diary.outbox import send_queued
+from diary import settings
+import time
+
+
+class Command(BaseCommand):
+    """
+    Worker to send the queued outbound emails.
+    """
+
+    help = "Send queued diary emails."
+
+
+    def add_arguments(self, parser):
+        """
+        Define the batch size and whether to keep polling the queue
+        -b --batch      number of emails per batch
+        -l --loop       keep polling the queue every n seconds
+        """
+        parser.add_argument(
+            '-b',
+            '--batch',
+            help="emails per batch",
+            type=int,
+            default=settings.DIARY_EMAIL_BATCH,
+        )
+        parser.add_argument(
+            '-l',
+            '--loop',
+            help="poll interval in seconds",
+            type=int,
+            default=0,
+        )
+
+
+    def handle(self, *args, **kwargs):
+        """
+        Drain the queue once, or repeatedly when looping.
+        """
+        while True:
+            sent, failed = send_queued(batch_size=kwargs['batch'])
+            if sent or failed or not kwargs['loop']:
+                print(f"Queued emails sent: {sent}, failed: {failed}")
+            if not kwargs['loop']:
+                break
+            time.sleep(kwargs['loop'])
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.17 on 2026-10-18 10:00
+
+import datetime
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def populate_end_times(apps, schema_editor):
+    """
+    Store the end time of existing entries, in batches of primary keys.
+
+    Periods running past midnight are clipped at the end of the day, as in
+    models.endTime().
+    """
+    Entry = apps.get_model('diary', 'Entry')
+    last_pk = 0
+    while True:
+        batch = list(
+            Entry.objects.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for entry in batch:
+            end = datetime.datetime.combine(
+                datetime.date.min,
+                entry.time,
+            ) + datetime.timedelta(
+                hours=entry.duration.hour,
+                minutes=entry.duration.minute,
+                seconds=entry.duration.second,
+                microseconds=entry.duration.microsecond,
+            )
+            entry.end_time = (
+                end.time() if end.date() == datetime.date.min
+                else datetime.time.max
+            )
+        Entry.objects.bulk_update(batch, ['end_time'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diary', '0010_resource_enabled_alter_resource_bg_color_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='end_time',
+            field=models.TimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_end_times, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='entry',
+            name='end_time',
+            field=models.TimeField(editable=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diary', '0011_entry_end_time'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['date', 'time', 'end_time'], name='diary_entry_date_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(condition=models.Q(('cancelled', False), ('no_show', False)), fields=['resource', 'date', 'time', 'end_time'], name='diary_entry_resource_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['customer', 'date', 'time', 'end_time'], name='diary_entry_customer_idx'),
+        ),
+    ]
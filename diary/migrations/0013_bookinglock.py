@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diary', '0012_entry_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('resource', 'Resource'), ('customer', 'Customer')], max_length=8)),
+                ('key', models.PositiveIntegerField()),
+                ('date', models.DateField()),
+                ('acquired', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='bookinglock',
+            constraint=models.UniqueConstraint(fields=('kind', 'key', 'date'), name='diary_bookinglock_unique'),
+        ),
+    ]
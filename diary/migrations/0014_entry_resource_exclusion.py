@@ -0,0 +1,57 @@
+from django.db import migrations
+
+from diary import settings
+
+
+CONSTRAINT = 'diary_entry_resource_excl'
+
+
+def wanted(schema_editor):
+    """
+    The exclusion constraint is optional and only exists on PostgreSQL.
+    """
+    return (
+        settings.DIARY_DB_EXCLUSION and
+        schema_editor.connection.vendor == 'postgresql'
+    )
+
+
+def add_constraint(apps, schema_editor):
+    """
+    Exclude overlapping active entries for the same resource.
+
+    Entries are naive local dates and times, so the periods are tsranges with
+    non-inclusive ends as for Entry.__eq__().
+    """
+    if not wanted(schema_editor):
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    schema_editor.execute(
+        'ALTER TABLE diary_entry ADD CONSTRAINT {0} EXCLUDE USING gist ('
+        'resource_id WITH =, '
+        "tsrange(date + time, date + end_time, '[)') WITH &&"
+        ') WHERE ('
+        'resource_id IS NOT NULL AND NOT cancelled AND NOT no_show'
+        ')'.format(CONSTRAINT)
+    )
+
+
+def remove_constraint(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'ALTER TABLE diary_entry DROP CONSTRAINT IF EXISTS {0}'.format(
+            CONSTRAINT,
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diary', '0013_bookinglock'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_constraint, remove_constraint),
+    ]
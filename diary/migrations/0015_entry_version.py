@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diary', '0014_entry_resource_exclusion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
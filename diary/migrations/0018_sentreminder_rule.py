@@ -0,0 +1,46 @@
+from django.db import migrations, models
+
+
+def copy_versions(apps, schema_editor):
+    """
+    Reminders already sent were for the day before rule, at the entry's
+    current version.
+    """
+    SentReminder = apps.get_model('diary', 'SentReminder')
+    for reminder in SentReminder.objects.select_related('entry'):
+        reminder.version = reminder.entry.version
+        reminder.save(update_fields=['version'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diary', '0017_sentreminder'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='sentreminder',
+            name='diary_sentreminder_unique',
+        ),
+        migrations.AddField(
+            model_name='sentreminder',
+            name='rule',
+            field=models.CharField(default='day', max_length=20),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='sentreminder',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_versions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='sentreminder',
+            constraint=models.UniqueConstraint(
+                fields=('entry', 'rule', 'version'),
+                name='diary_sentreminder_unique',
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('diary', '0018_sentreminder_rule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistoricEntry',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('time', models.TimeField()),
+                ('duration', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('notes', models.TextField(blank=True)),
+                ('created', models.DateTimeField()),
+                ('edited', models.DateTimeField()),
+                ('cancelled', models.BooleanField(default=False)),
+                ('no_show', models.BooleanField(default=False)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('creator', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='created_historic_entries', to=settings.AUTH_USER_MODEL)),
+                ('customer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='historic_entries', to='diary.customer')),
+                ('editor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='edited_historic_entries', to=settings.AUTH_USER_MODEL)),
+                ('resource', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='diary.resource')),
+                ('treatment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='diary.treatment')),
+            ],
+            options={
+                'verbose_name_plural': 'historic entries',
+                'indexes': [models.Index(fields=['customer', 'date', 'time'], name='diary_historic_customer_idx'), models.Index(fields=['date'], name='diary_historic_date_idx')],
+            },
+        ),
+    ]
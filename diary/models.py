@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction, connections, IntegrityError
 from django.contrib import admin
 import datetime
 from django.utils import timezone
@@ -11,6 +11,7 @@ from . import settings
 # Create your models here.
 
 DURATION_ZERO = datetime.time(hour=0)
+DATE_ZERO = datetime.date.min
 DEFAULT_DURATION = datetime.time(hour=1)
 DEFAULT_TIME = datetime.time(hour=12)
 
@@ -329,6 +330,216 @@ class Treatment(models.Model):
 
 
 
+class BookingLock(models.Model):
+    """
+    A row locked while booking a resource or customer on a date.
+
+    Entry.save() updates the lock rows for its resource and customer before
+    validating, holding their row locks until its transaction ends. Bookings
+    that could conflict are therefore validated and saved one at a time.
+    """
+
+    RESOURCE = 'resource'
+    CUSTOMER = 'customer'
+    KIND_CHOICES = (
+        (RESOURCE, 'Resource'),
+        (CUSTOMER, 'Customer'),
+    )
+
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    key = models.PositiveIntegerField()
+    date = models.DateField()
+    acquired = models.PositiveIntegerField(default=0)
+
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'key', 'date'],
+                name='diary_bookinglock_unique',
+            ),
+        ]
+
+
+    @classmethod
+    def acquire(cls, kind, key, date):
+        """
+        Lock the row for kind, key and date until the end of the current
+        transaction, creating it if need be.
+
+        Updating the row (rather than selecting it) takes the lock on every
+        database, including SQLite which serialises all writers.
+        """
+        lock = cls.objects.filter(kind=kind, key=key, date=date)
+        if lock.update(acquired=models.F('acquired') + 1):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(kind=kind, key=key, date=date, acquired=1)
+        except IntegrityError:
+            # created by a concurrent booking, so queue behind it
+            lock.update(acquired=models.F('acquired') + 1)
+
+
+    def __str__(self):
+        return '{0} {1} {2}'.format(self.kind, self.key, self.date)
+
+
+
+# the optional PostgreSQL constraint against resource clashes (migration 0014)
+RESOURCE_EXCLUSION_CONSTRAINT = 'diary_entry_resource_excl'
+
+
+def exclusionConstraintExists(connection):
+    """
+    Whether the resource exclusion constraint is in the PostgreSQL database.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_constraint WHERE conname = %s',
+            [RESOURCE_EXCLUSION_CONSTRAINT],
+        )
+        return cursor.fetchone() is not None
+
+
+def databaseExcludesClashes(using='default'):
+    """
+    Whether the database enforces against resource clashes.
+
+    The application-level check still runs to report clashes early, but races
+    past it are caught by the constraint, so no resource lock is needed.
+
+    The setting alone is not enough, as the constraint is only added if the
+    setting was on when migration 0014 ran. The constraint is looked up
+    once per database connection.
+    """
+    connection = connections[using]
+    if not (
+        settings.DIARY_DB_EXCLUSION and
+        connection.vendor == 'postgresql'
+    ):
+        return False
+    connection.ensure_connection()
+    checked = getattr(connection, 'diary_exclusion_checked', None)
+    if not checked or checked[0] is not connection.connection:
+        checked = (
+            connection.connection,
+            exclusionConstraintExists(connection),
+        )
+        connection.diary_exclusion_checked = checked
+    return checked[1]
+
+
+
+def durationDelta(duration):
+    """
+    Convert a duration-as-time to a duration-as-delta.
+    """
+    return datetime.timedelta(
+        hours=duration.hour,
+        minutes=duration.minute,
+        seconds=duration.second,
+        microseconds=duration.microsecond,
+    )
+
+
+def endTime(time, duration):
+    """
+    The end of a period from its start time and duration-as-time.
+
+    Periods running past midnight are clipped at the end of the day so that
+    stored end times always sort after their start times.
+    """
+    end = datetime.datetime.combine(DATE_ZERO, time) + durationDelta(duration)
+    return end.time() if end.date() == DATE_ZERO else datetime.time.max
+
+
+def statisticsAggregates():
+    """
+    Conditional aggregates counting the total, cancelled and no-show entries.
+    """
+    return {
+        'total': models.Count('pk'),
+        'cancelled': models.Count('pk', filter=models.Q(cancelled=True)),
+        'no_show': models.Count('pk', filter=models.Q(no_show=True)),
+    }
+
+
+
+class EntryQuerySet(models.QuerySet):
+    """
+    Entry queries with database-side statistics.
+    """
+
+
+    def daily_statistics(self):
+        """
+        Count the total, cancelled and no-show entries for each date in one
+        grouped query.
+
+        Returns a dictionary of counts keyed by date. Dates without entries are
+        absent.
+        """
+        rows = self.order_by().values('date').annotate(**statisticsAggregates())
+        return {row.pop('date'): row for row in rows}
+
+
+    def statistics(self):
+        """
+        Count the total, cancelled and no-show entries in one conditional
+        aggregate query.
+
+        Returns a dictionary of the counts, all zero if there are no entries.
+        """
+        return self.order_by().aggregate(**statisticsAggregates())
+
+
+    def overlapping(self, entry):
+        """
+        Entries sharing some time with the given entry on the same date,
+        excluding the entry itself.
+
+        This is the database equivalent of Entry.__eq__(), so entries starting
+        at the same time always overlap, and end times are non-inclusive.
+        """
+        overlaps = self.filter(
+            models.Q(time=entry.time) |
+            models.Q(
+                time__lt=endTime(entry.time, entry.duration),
+                end_time__gt=entry.time,
+            ),
+            date=entry.date,
+        )
+        if entry.pk:
+            overlaps = overlaps.exclude(pk=entry.pk)
+        return overlaps
+
+
+    def starting_between(self, start, end):
+        """
+        Entries starting after the naive datetime start and no later than end.
+        """
+        if start.date() == end.date():
+            return self.filter(
+                date=start.date(),
+                time__gt=start.time(),
+                time__lte=end.time(),
+            )
+        return self.filter(
+            models.Q(date=start.date(), time__gt=start.time()) |
+            models.Q(date__gt=start.date(), date__lt=end.date()) |
+            models.Q(date=end.date(), time__lte=end.time())
+        )
+
+
+
+class StaleEntryError(ValidationError):
+    """
+    Raised when saving an entry changed by someone else since it was read.
+    """
+
+
+
 class Entry(models.Model):
     """
     A diary entry, some event entered in the calendar.
@@ -348,6 +559,9 @@ class Entry(models.Model):
     # kludge for duration enables using a time widget
 #    duration = models.DurationField(blank=True, default=DEFAULT_DURATION)
     duration = models.TimeField(blank=True, default=DEFAULT_DURATION)
+    # stored end time enables range and overlap queries in the database,
+    # from the composite indexes below
+    end_time = models.TimeField(editable=False)
 
     notes = models.TextField(blank=True)
     creator = models.ForeignKey(
@@ -389,6 +603,10 @@ class Entry(models.Model):
     )
     cancelled = models.BooleanField(default=False)
     no_show = models.BooleanField(default=False)
+    # optimistic concurrency control: bumped by every save
+    version = models.PositiveIntegerField(default=0)
+
+    objects = EntryQuerySet.as_manager()
 
 
     def __str__(self):
@@ -414,22 +632,22 @@ class Entry(models.Model):
         """
         Convert duration-as-time to duration-as-delta.
         """
-        the_zero = datetime.datetime.combine(self.date, DURATION_ZERO)
-        the_duration = datetime.datetime.combine(self.date, self.duration)
-        return the_duration - the_zero
+        return durationDelta(self.duration)
 
 
     def time_end(self):
         """
         Calculate the time of the end of the entry from the start time and the
         duration.
-        Sadly the naive method of adding the duration directly to the time
-        is not supported in python datetime arithmetic; a datetime object has
-        to be used.
+
+        This is evaluated afresh as the time or duration may have changed since
+        the entry was saved; end_time holds the value stored in the database.
         """
-        the_time = datetime.datetime.combine(self.date, self.time)
-        the_time_end = the_time + self.duration_delta()
-        return the_time_end.time()
+        end = (
+            datetime.datetime.combine(DATE_ZERO, self.time) +
+            self.duration_delta()
+        )
+        return end.time()
 
 
     def __eq__(self, other):
@@ -493,34 +711,44 @@ class Entry(models.Model):
                 )
 
 
+    STALE_MESSAGE = (
+        'This entry has been changed by someone else. Please reload it and '
+        'try again.'
+    )
+    RESOURCE_CLASH_MESSAGE = (
+        'Resource clash with another Entry. Please change resource or time.'
+    )
+    DOUBLE_BOOKING_MESSAGE = (
+        'Double booking is not allowed. Please choose another time.'
+    )
+
+
+    def activeOverlaps(self):
+        """
+        Uncancelled entries overlapping this one in time on the same day.
+        """
+        return Entry.objects.filter(
+            cancelled=False,
+            no_show=False,
+        ).overlapping(self)
+
+
     def validateNoResourceConflicts(self):
         """
         Context validation of date, time, duration and resource.
 
         The entry is invalid if it clashes in time and resource with
         a pre-existing entry. Cancelled entries don't count.
+
+        The clash is found by a single existence query in the database.
         """
         if self.cancelled or self.no_show:
             return
 
-        if self.resource:
-
-            # get the day's uncancelled entries sharing the same resource
-            savedEntries = Entry.objects.filter(
-                date=self.date,
-                resource=self.resource,
-                cancelled=False,
-                no_show=False,
-            )
-
-            # ensure no time clashes
-            for other in savedEntries:
-                if self == other:
-                    # if we are just saving the same entry, its OK
-                    if not self.pk or (self.pk and self.pk != other.pk):
-                        raise ValidationError(
-    'Resource clash with another Entry. Please change resource or time.'
-                        )
+        if self.resource_id and self.activeOverlaps().filter(
+            resource_id=self.resource_id,
+        ).exists():
+            raise ValidationError(self.RESOURCE_CLASH_MESSAGE)
 
 
     def validateCustomerNotDoubleBooked(self):
@@ -529,28 +757,54 @@ class Entry(models.Model):
 
         A named customer cannot have two entries at the same time, irrespective
         of other resource criteria. Cancelled entries don't count.
+
+        The clash is found by a single existence query in the database.
         """
         if self.cancelled or self.no_show:
             return
 
-        if self.customer:
+        if self.customer_id and self.activeOverlaps().filter(
+            customer_id=self.customer_id,
+        ).exists():
+            raise ValidationError(self.DOUBLE_BOOKING_MESSAGE)
 
-            # get any uncancelled entries for the same customer on the same day
-            savedEntries = Entry.objects.filter(
-                date=self.date,
-                customer=self.customer,
-                cancelled=False,
-                no_show=False,
-            )
 
-            # ensure no time clashes
-            for other in savedEntries:
-                if self == other:
-                    # if we are just saving the same entry, its OK
-                    if not self.pk or (self.pk and self.pk != other.pk):
-                        raise ValidationError(
-    'Double booking is not allowed. Please choose another time.'
-                        )
+    def validateNoConflicts(self):
+        """
+        Context validation of resource clashes and customer double bookings
+        together, in one database round trip.
+
+        A resource clash is reported in preference to a double booking.
+        """
+        if self.cancelled or self.no_show:
+            return
+
+        # one arm per rule, so that each can use its own index
+        arms = []
+        if self.resource_id:
+            arms.append(self.activeOverlaps().filter(
+                resource_id=self.resource_id,
+            ))
+        if self.customer_id:
+            arms.append(self.activeOverlaps().filter(
+                customer_id=self.customer_id,
+            ))
+        if not arms:
+            return
+        arms = [arm.values_list('resource_id', 'customer_id') for arm in arms]
+        overlaps = arms[0].union(*arms[1:], all=True)
+
+        resource_clash = customer_clash = False
+        for resource_id, customer_id in overlaps:
+            if self.resource_id and resource_id == self.resource_id:
+                resource_clash = True
+            if self.customer_id and customer_id == self.customer_id:
+                customer_clash = True
+
+        if resource_clash:
+            raise ValidationError(self.RESOURCE_CLASH_MESSAGE)
+        if customer_clash:
+            raise ValidationError(self.DOUBLE_BOOKING_MESSAGE)
 
 
     def validateTradingHours(self):
@@ -603,6 +857,25 @@ class Entry(models.Model):
                 )
 
 
+    def bookingLocks(self):
+        """
+        The (kind, key, date) booking locks to hold while saving, in a fixed
+        order so that concurrent bookings cannot deadlock.
+
+        Cancelled entries and no-shows can't conflict, so need no locks.
+        Where the database excludes resource clashes, it serialises them
+        itself and only customers are locked.
+        """
+        if self.cancelled or self.no_show:
+            return []
+        locks = []
+        if self.resource_id and not databaseExcludesClashes():
+            locks.append((BookingLock.RESOURCE, self.resource_id, self.date))
+        if self.customer_id:
+            locks.append((BookingLock.CUSTOMER, self.customer_id, self.date))
+        return sorted(locks)
+
+
     def clean(self, *args, **kwargs):
         """
         Override Model method to validate the content in context.
@@ -611,8 +884,7 @@ class Entry(models.Model):
         """
         self.validateResourceRequirement()
         self.validateDuration()
-        self.validateNoResourceConflicts()
-        self.validateCustomerNotDoubleBooked()
+        self.validateNoConflicts()
         self.validateTradingHours()
         self.validateFuture()
 
@@ -624,10 +896,245 @@ class Entry(models.Model):
         """
         Override the parent method to ensure custom validation in clean() is
         done.
+
+        The validation and save happen atomically under the booking locks, so
+        two conflicting bookings can't both pass validation. A resource clash
+        caught by the database constraint is reported as in validation.
+
+        Updates only succeed if the entry is unchanged since it was read, see
+        _do_update().
         """
-        self.full_clean()
-        super(Entry, self).save(*args, **kwargs)
+        self.end_time = endTime(self.time, self.duration)
+        if kwargs.get('update_fields') is not None:
+            # the fields recalculated here are always written
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {
+                'end_time',
+                'version',
+            }
+        version = self.version
+        if not self._state.adding:
+            self._expected_version = version
+            self.version = version + 1
+        saved = False
+        try:
+            with transaction.atomic():
+                for kind, key, date in self.bookingLocks():
+                    BookingLock.acquire(kind, key, date)
+                self.full_clean()
+                super(Entry, self).save(*args, **kwargs)
+            saved = True
+        except IntegrityError as e:
+            if RESOURCE_EXCLUSION_CONSTRAINT in str(e):
+                raise ValidationError(self.RESOURCE_CLASH_MESSAGE)
+            raise
+        finally:
+            self._expected_version = None
+            if not saved:
+                self.version = version
+
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+        forced_update):
+        """
+        Override the parent method to make the update conditional on the
+        version this entry was read at, as in UPDATE ... WHERE version = n.
+
+        A stale write updates nothing and is rejected without taking locks.
+        """
+        expected = getattr(self, '_expected_version', None)
+        if expected is None:
+            return super(Entry, self)._do_update(
+                base_qs, using, pk_val, values, update_fields, forced_update,
+            )
+        updated = super(Entry, self)._do_update(
+            base_qs.filter(version=expected),
+            using, pk_val, values, update_fields, forced_update,
+        )
+        if not updated and base_qs.filter(pk=pk_val).exists():
+            raise StaleEntryError(self.STALE_MESSAGE)
+        return updated
 
 
     class Meta:
         verbose_name_plural = 'entries'
+        indexes = [
+            # diary grids, statistics, reminders and staff reminders; the end
+            # time lets overlap queries filter in the index
+            models.Index(
+                fields=['date', 'time', 'end_time'],
+                name='diary_entry_date_time_idx',
+            ),
+            # resource conflicts only involve active entries
+            models.Index(
+                fields=['resource', 'date', 'time', 'end_time'],
+                condition=models.Q(cancelled=False, no_show=False),
+                name='diary_entry_resource_idx',
+            ),
+            # double bookings, customer month, reminders and history
+            models.Index(
+                fields=['customer', 'date', 'time', 'end_time'],
+                name='diary_entry_customer_idx',
+            ),
+        ]
+
+
+
+class OutboundEmail(models.Model):
+    """
+    A queued email, sent later by the send_queued_email command so that
+    request handlers never wait on the mail server.
+
+    Failed sends are retried with exponential backoff until they succeed or
+    run out of attempts. Sent and given up emails are kept until cleaned out
+    with the entries of their time by clean_entries.
+    """
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipients = models.TextField()             # one address per line
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+
+    class Meta:
+        indexes = [
+            # the queue is the unsent emails in order of their next attempt
+            models.Index(
+                fields=['next_attempt'],
+                condition=models.Q(sent__isnull=True),
+                name='diary_outbound_queue_idx',
+            ),
+        ]
+
+
+    def recipient_list(self):
+        return self.recipients.split('\n')
+
+
+    def __str__(self):
+        return '{0} to {1}'.format(self.subject, ', '.join(self.recipient_list()))
+
+
+
+class SentReminder(models.Model):
+    """
+    The ledger of reminder emails sent, so that email_reminder never sends
+    the same reminder twice however often it runs.
+
+    A reminder is identified by its entry, its rule (see
+    DIARY_REMINDER_RULES) and the version of the entry it reminds of, so
+    an entry changed after its reminder was sent is reminded of again.
+    """
+
+    entry = models.ForeignKey(
+        Entry,
+        related_name='sent_reminders',
+        on_delete=models.CASCADE,
+    )
+    rule = models.CharField(max_length=20)
+    version = models.PositiveIntegerField()
+    sent = models.DateTimeField(auto_now_add=True)
+
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['entry', 'rule', 'version'],
+                name='diary_sentreminder_unique',
+            ),
+        ]
+
+
+    def __str__(self):
+        return '{0} reminded ({1}) {2}'.format(self.entry, self.rule, self.sent)
+
+
+
+class HistoricEntry(models.Model):
+    """
+    An old diary entry, moved out of the Entry table into cold storage by the
+    move_historic_entries command.
+
+    Keeping old entries apart keeps the Entry table small, so the diary
+    grids, availability and booking validation only ever query recent
+    entries. Historic entries keep their original primary keys and are only
+    read, by the customer history and statistics.
+    """
+
+    historic = True     # tells the templates not to offer editing
+
+    id = models.IntegerField(primary_key=True)  # the Entry's primary key
+    date = models.DateField()
+    time = models.TimeField()
+    duration = models.TimeField()
+    end_time = models.TimeField()
+    notes = models.TextField(blank=True)
+    creator = models.ForeignKey(
+        User,
+        blank=True,
+        null=True,
+        related_name='created_historic_entries',
+        on_delete=models.CASCADE,
+    )
+    created = models.DateTimeField()
+    editor = models.ForeignKey(
+        User,
+        blank=True,
+        null=True,
+        related_name='edited_historic_entries',
+        on_delete=models.CASCADE,
+    )
+    edited = models.DateTimeField()
+    customer = models.ForeignKey(
+        Customer,
+        blank=True,
+        null=True,
+        related_name='historic_entries',
+        on_delete=models.CASCADE,
+    )
+    treatment = models.ForeignKey(
+        Treatment,
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+    )
+    resource = models.ForeignKey(
+        Resource,
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+    )
+    cancelled = models.BooleanField(default=False)
+    no_show = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=0)
+
+    objects = EntryQuerySet.as_manager()
+
+
+    class Meta:
+        verbose_name_plural = 'historic entries'
+        indexes = [
+            # customer history and statistics
+            models.Index(
+                fields=['customer', 'date', 'time'],
+                name='diary_historic_customer_idx',
+            ),
+            # cleaning out by date
+            models.Index(
+                fields=['date'],
+                name='diary_historic_date_idx',
+            ),
+        ]
+
+
+    def __str__(self):
+        return Entry.__str__(self)
+
+
+    def duration_delta(self):
+        return durationDelta(self.duration)
+
@@ -0,0 +1,129 @@
+"""
+The outbound email queue.
+
+Request handlers enqueue emails as rows of the OutboundEmail table, in the
+same transaction as the change they report. The send_queued_email command
+drains the queue in batches over one reused mail server connection,
+retrying failures with exponential backoff. Each email is claimed before it
+is sent, so drains running at the same time never send it twice.
+"""
+from django.core import mail
+from django.db import models
+from django.utils import timezone
+
+from .models import OutboundEmail
+from . import settings
+
+
+
+def enqueue(subject, body, from_email, recipients):
+    """
+    Queue an email for sending. Returns the queued email.
+    """
+    return OutboundEmail.objects.create(
+        subject=subject,
+        body=body,
+        from_email=from_email,
+        recipients='\n'.join(recipients),
+    )
+
+
+def backoff(attempts):
+    """
+    The delay before the next attempt after a number of failed attempts.
+    """
+    return settings.DIARY_EMAIL_BACKOFF * 2 ** (attempts - 1)
+
+
+def due(now):
+    """
+    The queued emails due for an attempt at the given time, oldest first.
+    """
+    return OutboundEmail.objects.filter(
+        sent__isnull=True,
+        next_attempt__lte=now,
+        attempts__lt=settings.DIARY_EMAIL_ATTEMPTS,
+    ).order_by('pk')
+
+
+def claim(email):
+    """
+    Claim a queued email for sending by counting the attempt, conditional on
+    nobody else having done so since it was read. The claim also puts off the
+    next attempt, so an email whose sender dies is retried after the backoff.
+    Returns whether the claim succeeded.
+    """
+    attempts = email.attempts + 1
+    claimed = OutboundEmail.objects.filter(
+        pk=email.pk,
+        attempts=email.attempts,
+        sent__isnull=True,
+    ).update(
+        attempts=attempts,
+        next_attempt=timezone.now() + backoff(attempts),
+    )
+    email.attempts = attempts
+    return bool(claimed)
+
+
+def purge(before):
+    """
+    Delete the emails created before a datetime that have been sent or given
+    up. Returns the number deleted.
+    """
+    deleted, counts = OutboundEmail.objects.filter(
+        models.Q(sent__isnull=False) |
+        models.Q(attempts__gte=settings.DIARY_EMAIL_ATTEMPTS),
+        created__lt=before,
+    ).delete()
+    return deleted
+
+
+def send_queued(batch_size=None, now=None, connection=None):
+    """
+    Send the queued emails due now, in batches over one connection to the
+    mail server. Returns the numbers of emails sent and failed.
+
+    Each email is claimed before it is sent, and marked sent, or rescheduled
+    with backoff, as soon as it has been tried, so an interrupted run loses
+    nothing. Failures are not retried within the run.
+    """
+    batch_size = batch_size or settings.DIARY_EMAIL_BATCH
+    now = now or timezone.now()
+    connection = connection or mail.get_connection()
+    sent = failed = 0
+    lastPk = 0
+    try:
+        while True:
+            batch = list(due(now).filter(pk__gt=lastPk)[:batch_size])
+            if not batch:
+                break
+            for email in batch:
+                if not claim(email):
+                    continue                # taken by another drain
+                try:
+                    connection.open()       # no-op while already open
+                    mail.EmailMessage(
+                        email.subject,
+                        email.body,
+                        email.from_email,
+                        email.recipient_list(),
+                        connection=connection,
+                    ).send()
+                except Exception as e:
+                    connection.close()      # reconnect for the next email
+                    OutboundEmail.objects.filter(pk=email.pk).update(
+                        next_attempt=now + backoff(email.attempts),
+                        last_error=repr(e),
+                    )
+                    failed += 1
+                else:
+                    OutboundEmail.objects.filter(pk=email.pk).update(
+                        sent=timezone.now(),
+                        last_error='',
+                    )
+                    sent += 1
+            lastPk = batch[-1].pk
+    finally:
+        connection.close()
+    return sent, failed
@@ -0,0 +1,238 @@
+"""
+The email reminder pipeline used by the email_reminder command.
+
+Reminder rules (DIARY_REMINDER_RULES) give lead times before an entry when
+its reminder is due. Entries that have entered a rule's window are streamed
+from the database in chunks with their related objects. Each chunk is
+rendered by a pool of threads and sent over one mail server connection.
+Every reminder is claimed in the SentReminder ledger by entry, rule and
+entry version before it is sent, so neither repeated nor overlapping runs
+ever send a reminder twice.
+"""
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from django.core import mail
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef
+from django.template.loader import render_to_string
+from django.conf import settings as main_settings
+
+from .models import Entry, SentReminder
+from . import settings
+
+
+
+def windows(now, rules=None):
+    """
+    The (rule, start, end) windows of entry start times due reminders at the
+    naive datetime now, shortest lead time first.
+
+    Each window runs from the next shorter lead time to the rule's own, so an
+    entry only gets the reminders for lead times still ahead of it.
+    """
+    rules = rules if rules is not None else settings.DIARY_REMINDER_RULES
+    result = []
+    start = now
+    for rule, lead in sorted(rules.items(), key=lambda item: item[1]):
+        result.append((rule, start, now + lead))
+        start = now + lead
+    return result
+
+
+def remindable():
+    """
+    The entries whose customers want reminders.
+    """
+    return Entry.objects.filter(
+        cancelled=False, # reminders not needed for cancelled entries
+        customer__email__gt='', # test for non-blank (not non-null) email
+        customer__opt_out_entry_reminder_email=False, # customer wants them
+    )
+
+
+def due(rule, start, end):
+    """
+    The entries starting in the window from start to end not yet reminded
+    of by the rule at their current version.
+    """
+    sent = SentReminder.objects.filter(
+        entry=OuterRef('pk'),
+        rule=rule,
+        version=OuterRef('version'),
+    )
+    return remindable().starting_between(start, end).filter(
+        ~Exists(sent),
+    ).select_related(
+        'customer',
+        'treatment',
+        'resource',
+    ).order_by('date', 'time', 'pk')
+
+
+def next_deadline(now, horizon, rules=None):
+    """
+    The earliest time after the naive datetime now and within the horizon (a
+    timedelta) when an entry enters a reminder rule's window, or None.
+
+    This is one small indexed query per rule.
+    """
+    rules = rules if rules is not None else settings.DIARY_REMINDER_RULES
+    deadlines = []
+    for rule, lead in rules.items():
+        first = remindable().starting_between(
+            now + lead,
+            now + lead + horizon,
+        ).order_by('date', 'time').values_list('date', 'time').first()
+        if first:
+            deadlines.append(datetime.datetime.combine(*first) - lead)
+    return min(deadlines, default=None)
+
+
+def chunked(entries, size):
+    """
+    Stream the entries from the database in lists of at most size.
+    """
+    chunk = []
+    for entry in entries.iterator(chunk_size=size):
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def render(entry):
+    """
+    The reminder email for an entry. Safe to call from worker threads as
+    the entry's related objects are already loaded.
+    """
+    return mail.EmailMessage(
+        settings.DIARY_SITE_NAME+': Appointment Reminder',
+        render_to_string(
+            'diary/email_reminder.txt',
+            context={
+                'entry': entry,
+                'site_name': settings.DIARY_SITE_NAME,
+                'contact_email': main_settings.DEFAULT_FROM_EMAIL,
+                'contact_phone': settings.DIARY_CONTACT_PHONE,
+            },
+        ),
+        main_settings.DEFAULT_FROM_EMAIL,
+        [entry.customer.email],
+    )
+
+
+def summarise(entry):
+    """
+    A line for the site admins' summary of reminders sent.
+    """
+    return '{0} <{1}>: {2} {3}:  {4}'.format(
+        entry.customer,
+        entry.customer.email,
+        entry.date,
+        entry.time,
+        entry.treatment,
+    )
+
+
+def claim(rule, entry):
+    """
+    Claim the rule's reminder of the entry by adding it to the ledger in its
+    own short transaction. Returns the ledger row, or None if another run
+    has already claimed the reminder.
+    """
+    try:
+        with transaction.atomic():
+            return SentReminder.objects.create(
+                entry=entry,
+                rule=rule,
+                version=entry.version,
+            )
+    except IntegrityError:                  # diary_sentreminder_unique
+        return None
+
+
+def send_batch(rule, batch, messages, connection, sent, failed):
+    """
+    Send a batch of rendered reminders, adding their summary lines to sent
+    or failed. Each reminder is claimed before it is sent and released again
+    if sending fails, so that it is tried again by the next run.
+    """
+    for entry, message in zip(batch, messages):
+        claimed = claim(rule, entry)
+        if claimed is None:
+            continue                        # sent by an overlapping run
+        try:
+            message = message.result()
+            message.connection = connection
+            connection.open()               # no-op while already open
+            message.send()
+        except Exception as e:
+            claimed.delete()
+            connection.close()              # reconnect for the next one
+            failed.append('{0} ({1!r})'.format(summarise(entry), e))
+        else:
+            sent.append(summarise(entry))
+
+
+def send_reminders(rule, entries, batch_size=None, workers=None,
+    connection=None):
+    """
+    Render and send the rule's reminders for the entries over one connection.
+
+    Returns lists of the summary lines of the reminders sent and of those
+    that failed. A failure only affects its own reminder.
+    """
+    batch_size = batch_size or settings.DIARY_EMAIL_BATCH
+    workers = workers or settings.DIARY_EMAIL_WORKERS
+    connection = connection or mail.get_connection()
+    sent, failed = [], []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in chunked(entries, batch_size):
+                messages = [executor.submit(render, entry) for entry in batch]
+                send_batch(rule, batch, messages, connection, sent, failed)
+    finally:
+        connection.close()
+    return sent, failed
+
+
+def remind(now, batch_size=None, workers=None, connection=None):
+    """
+    Send every reminder due at the naive datetime now, rule by rule, and
+    summarise them for the site admins if there is anything to say.
+
+    Returns lists of the summary lines of the reminders sent and failed.
+    """
+    connection = connection or mail.get_connection()
+    sent, failed = [], []
+    for rule, start, end in windows(now):
+        ruleSent, ruleFailed = send_reminders(
+            rule,
+            due(rule, start, end),
+            batch_size=batch_size,
+            workers=workers,
+            connection=connection,
+        )
+        sent += ruleSent
+        failed += ruleFailed
+
+    if not (sent or failed):
+        return sent, failed
+    admin_message = 'Reminders sent to {0} customers:\n\n'.format(len(sent))
+    admin_message += '\n'.join(sent)
+    if failed:
+        admin_message += '\n\nReminders failed for {0} customers:\n\n'.format(
+            len(failed),
+        )
+        admin_message += '\n'.join(failed)
+    mail.send_mail(
+        settings.DIARY_SITE_NAME +
+            ': Reminders Summary for {0} at {1}'.format(now.date(), now.time()),
+        admin_message,
+        main_settings.SERVER_EMAIL,
+        [email for name, email in main_settings.ADMINS],
+        connection=connection,
+    )
+    return sent, failed
@@ -0,0 +1,164 @@
+"""
+A resident scheduler for the diary's periodic work.
+
+The run_diary_scheduler command keeps one process running the jobs below
+as they fall due, instead of starting Django afresh from cron for each
+run. Jobs wait in a heap keyed by their next due time. The scheduler sleeps
+until the earliest of them, but never longer than DIARY_SCHEDULER_POLL, so
+that new bookings and queued emails are picked up promptly.
+"""
+import datetime
+import heapq
+import itertools
+import logging
+import time
+from django.core.management import call_command
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import outbox
+from . import reminders
+from . import settings
+
+
+MIN_INTERVAL = datetime.timedelta(seconds=1)
+
+logger = logging.getLogger(__name__)
+
+
+
+def localNow():
+    """
+    The current local time as a naive datetime, like entry dates and times.
+    """
+    return timezone.localtime(timezone.now()).replace(tzinfo=None)
+
+
+
+class Scheduler(object):
+    """
+    A heap of jobs in order of their next due time.
+
+    A job is a callable taking the current time and returning when it is
+    next due, or None when it is done. The clock and sleep functions can be
+    replaced, e.g. to test with a fake clock.
+    """
+
+
+    def __init__(self, clock=localNow, sleep=time.sleep, poll=None):
+        self.clock = clock
+        self.sleep = sleep
+        self.poll = poll or settings.DIARY_SCHEDULER_POLL
+        self.queue = []
+        self.counter = itertools.count()    # first come first served on ties
+
+
+    def schedule(self, when, job):
+        """
+        Add a job to run at the given time.
+        """
+        heapq.heappush(self.queue, (when, next(self.counter), job))
+
+
+    def next_due(self):
+        """
+        The time the earliest job is due, or None if there are no jobs.
+        """
+        return self.queue[0][0] if self.queue else None
+
+
+    def run_pending(self):
+        """
+        Run the jobs due now and reschedule them. Returns the number run.
+
+        A failing job is logged with its traceback and retried after the poll
+        interval, so one bad run can't stop the scheduler.
+        """
+        now = self.clock()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            due.append(heapq.heappop(self.queue)[2])
+        for job in due:
+            close_old_connections()
+            try:
+                when = job(now)
+            except Exception:
+                logger.exception(
+                    'Scheduled job %s failed',
+                    getattr(job, '__name__', job),
+                )
+                when = now + self.poll
+            if when is not None:
+                self.schedule(max(when, now + MIN_INTERVAL), job)
+        return len(due)
+
+
+    def wait(self):
+        """
+        Sleep until the next job is due, or for the poll interval at most.
+        """
+        delay = self.poll
+        if self.queue:
+            delay = min(self.next_due() - self.clock(), delay)
+        if delay > datetime.timedelta(0):
+            self.sleep(delay.total_seconds())
+
+
+    def run(self, cycles=None):
+        """
+        Run jobs as they fall due, for ever or for a number of cycles.
+        """
+        for cycle in itertools.count() if cycles is None else range(cycles):
+            self.run_pending()
+            self.wait()
+
+
+
+def send_reminders(now):
+    """
+    Send the reminders due, then wake when the next entry enters a reminder
+    window, or after the poll interval.
+    """
+    reminders.remind(now)
+    poll = settings.DIARY_SCHEDULER_POLL
+    deadline = reminders.next_deadline(now, poll)
+    return deadline if deadline else now + poll
+
+
+def send_queued_email(now):
+    """
+    Drain the outbound email queue every poll interval.
+    """
+    outbox.send_queued()
+    return now + settings.DIARY_SCHEDULER_POLL
+
+
+def clean_entries(now):
+    """
+    Clean out old entries once a day.
+    """
+    call_command('clean_entries', age=settings.DIARY_CLEAN_AGE)
+    return now + datetime.timedelta(days=1)
+
+
+def move_historic_entries(now):
+    """
+    Move old entries into cold storage once a day.
+    """
+    call_command('move_historic_entries', age=settings.DIARY_HISTORIC_AGE)
+    return now + datetime.timedelta(days=1)
+
+
+def diary_scheduler(**kwargs):
+    """
+    A scheduler with all the diary's jobs due now.
+    """
+    scheduler = Scheduler(**kwargs)
+    now = scheduler.clock()
+    scheduler.schedule(now, send_reminders)
+    scheduler.schedule(now, send_queued_email)
+    if settings.DIARY_CLEAN_AGE:
+        scheduler.schedule(now, clean_entries)
+    if settings.DIARY_HISTORIC_AGE:
+        scheduler.schedule(now, move_historic_entries)
+    return scheduler
@@ -54,3 +54,41 @@ DIARY_SITE_NAME = get('DIARY_SITE_NAME', 'Django-Diary')
 # contact phone number for use by email_reminder
 DIARY_CONTACT_PHONE = get('DIARY_CONTACT_PHONE', '')
 
+# maximum lifetime in seconds of cached diary data, defaults to one hour
+DIARY_CACHE_TIMEOUT = get('DIARY_CACHE_TIMEOUT', 60*60)
+
+
+# default and maximum number of days covered by an availability search
+DIARY_AVAILABILITY_DAYS = get('DIARY_AVAILABILITY_DAYS', 14)
+
+# number of entries in each page of a customer's history
+DIARY_HISTORY_PAGE = get('DIARY_HISTORY_PAGE', 50)
+
+# whether PostgreSQL enforces against resource clashes, defaults to False
+DIARY_DB_EXCLUSION = get('DIARY_DB_EXCLUSION', False)
+
+# number of queued emails sent per batch by send_queued_email
+DIARY_EMAIL_BATCH = get('DIARY_EMAIL_BATCH', 100)
+
+# number of attempts to send a queued email before giving up
+DIARY_EMAIL_ATTEMPTS = get('DIARY_EMAIL_ATTEMPTS', 5)
+
+# delay before retrying a failed email, doubled after each further failure
+DIARY_EMAIL_BACKOFF = get('DIARY_EMAIL_BACKOFF', datetime.timedelta(minutes=1))
+
+# number of threads rendering reminder emails
+DIARY_EMAIL_WORKERS = get('DIARY_EMAIL_WORKERS', 4)
+
+# reminder rules, names mapped to how long before an entry to send reminders
+DEFAULT_REMINDER_RULES = {'day': datetime.timedelta(hours=24)}
+DIARY_REMINDER_RULES = get('DIARY_REMINDER_RULES', DEFAULT_REMINDER_RULES)
+
+# longest time the scheduler sleeps before checking for new work
+DIARY_SCHEDULER_POLL = get('DIARY_SCHEDULER_POLL', datetime.timedelta(minutes=5))
+
+# age in years of entries cleaned daily by the scheduler, 0 for never
+DIARY_CLEAN_AGE = get('DIARY_CLEAN_AGE', 0)
+
+# age in years of entries moved daily to cold storage by the scheduler, 0 for
+# never
+DIARY_HISTORIC_AGE = get('DIARY_HISTORIC_AGE', 0)
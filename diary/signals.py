@@ -0,0 +1,48 @@
+"""
+Signal handlers keeping the diary caches in step with Entry changes.
+
+The caches are only invalidated once the change is committed, so a request
+reading them meanwhile can't cache the old data again after invalidation.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import Entry
+from . import caching
+
+
+
+@receiver(post_init, sender=Entry)
+def entry_loaded(sender, instance, **kwargs):
+    """
+    Remember the date an entry had when loaded, to catch entries that move.
+    """
+    instance._loaded_date = instance.date
+
+
+def invalidate(*dates):
+    """
+    Invalidate the cached data for the dates when the transaction commits.
+    """
+    def invalidate_dates():
+        caching.invalidate_occupancy(*dates)
+        caching.invalidate_reminders(*dates)
+    transaction.on_commit(invalidate_dates)
+
+
+@receiver(post_save, sender=Entry)
+def entry_saved(sender, instance, **kwargs):
+    """
+    Invalidate the cached data for the entry's old and new dates.
+    """
+    invalidate(instance._loaded_date, instance.date)
+    instance._loaded_date = instance.date
+
+
+@receiver(post_delete, sender=Entry)
+def entry_deleted(sender, instance, **kwargs):
+    """
+    Invalidate the cached data for a deleted entry's date.
+    """
+    invalidate(instance._loaded_date, instance.date)
@@ -59,14 +59,16 @@ function drop(ev) {
     var pk = ev.dataTransfer.getData("text/html");
     //console.log('pk from data transfer is ['+pk+']');
     var slug = ev.target.id;
+    var version = document.getElementById(pk).getAttribute('data-version');
     /* ajax stuff goes here */
     $.ajax({
         url: entry_dnd_url,
         type: "post",
-        data: {pk: pk, slug: slug},
+        data: {pk: pk, slug: slug, version: version},
         success: function(result) {
             /* if the post succeeds continue with the drop */
             dragElement = document.getElementById(pk);
+            dragElement.setAttribute('data-version', result.version);
             ev.target.appendChild(dragElement);
             dragElement.classList.remove('cancelled');
             dragElement.classList.remove('no_show');
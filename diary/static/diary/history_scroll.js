@@ -0,0 +1,48 @@
+/* infinite scrolling of a customer's history: when the page is scrolled near
+the bottom the next page of entries is fetched as html and appended, until
+the server reports there are no more. */
+
+
+var history_loading = false;
+
+
+/* fetch and append the next page of entries, if there is one */
+function load_history() {
+    var container = $('#history_entries');
+    var href = container.data('next');
+    if (!href || history_loading) {
+        return;
+    }
+    history_loading = true;
+    console.log('Retrieving history from '+href);
+    $.ajax({
+        url: href,
+        type: "get",
+        datatype: "json",
+        success: function(result) {
+            container.append(result.html);
+            container.data('next', result.next || '');
+            history_loading = false;
+            /* keep going until the window is filled */
+            load_history_if_needed();
+        },
+        error: function (xhr, ajaxOptions, thrownError) {
+            console.log(xhr);
+            history_loading = false;
+        }
+    });
+}
+
+
+/* load more entries if the end of the history is in or near the window */
+function load_history_if_needed() {
+    var container = $('#history_entries');
+    var bottom = container.offset().top + container.outerHeight();
+    if (bottom < $(window).scrollTop() + $(window).height() + 200) {
+        load_history();
+    }
+}
+
+
+$(window).on('scroll resize', load_history_if_needed);
+$(document).ready(load_history_if_needed);
@@ -1,9 +1,17 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from django.utils import timezone
 import datetime
 from django.forms import ValidationError
 import traceback
+import threading
+import io
+import contextlib
+import socketserver
+import tempfile
+import os
+import unittest
+from unittest import mock
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.conf import settings as main_settings
@@ -14,16 +22,39 @@ import importlib as imp         # since Python 3.4
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from freezegun import freeze_time
+from django.db import connection, transaction, IntegrityError
+from django.test.utils import CaptureQueriesContext
+from django.db.migrations.executor import MigrationExecutor
 
 
 # Create your tests here.
 
-from .models import Customer, Treatment, Resource, Entry
+from .models import (
+    Customer, Treatment, Resource, Entry, BookingLock, OutboundEmail,
+    SentReminder, HistoricEntry, StaleEntryError,
+)
+from .grid import DiaryGrid
+from .intervals import Occupancy
+from .availability import availability, Window
+from . import archive
+from . import caching
+from . import historic
+from . import outbox
+from . import reminders
+from . import scheduler
+from . import models
+from .caching import occupancy
+from django.core.cache import cache
+from django.core import mail
+from django.core.mail.backends import locmem
 from django.contrib.auth.models import User
 
 
 TIME_ZERO = datetime.time(0,0)
 
+# log test clients in with the standard backend
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
 
 def yearsago(years, from_date=None):
     """
@@ -1006,3 +1037,2612 @@ class Clean_Entry_Tests(TestCase):
         call_command('clean_entries', '-a=3', '-b=2012-07-01')
         entries = Entry.objects.all()
         self.assertEqual(1, len(entries))
+
+
+    @freeze_time('2020-02-29 12:00:00')
+    def test_age_on_leap_day(self):
+        """
+        Make sure an age counted back from 29th February ends on the 28th in
+        years without one, for both cleaning and moving to cold storage.
+        """
+        self.assertEqual(
+            views.yearsBefore(datetime.date(2020, 2, 29), 1),
+            datetime.date(2019, 2, 28),
+        )
+        self.assertEqual(
+            views.yearsBefore(datetime.date(2020, 2, 29), 4),
+            datetime.date(2016, 2, 29),
+        )
+        for day in (26, 27, 28):
+            create_entry(
+                datetime.date(2019, 2, day),
+                t(10),
+                datetime.timedelta(hours=1),
+                'old',
+            ).save()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('move_historic_entries', '-a=1', '--chunk=1')
+            call_command('clean_entries', '-a=1')
+        self.assertEqual(
+            output.getvalue(),
+            'Moving 2 entries older than 1 years ... 1/2 ... 2/2 ... Done\n'
+            'Cleaning 2 entries older than 1 years ... 2/2 ... Done\n',
+        )
+        self.assertEqual(
+            list(Entry.objects.values_list('date', flat=True)),
+            [datetime.date(2019, 2, 28)],
+        )
+
+
+    def create_old_entries(self, n):
+        """
+        Make n entries on successive days in 2010, each with a reminder.
+        """
+        for day in range(n):
+            entry = create_entry(
+                datetime.date(2010, 1, 1) + datetime.timedelta(days=day),
+                t(10),
+                datetime.timedelta(hours=1),
+                'old',
+            )
+            entry.save()
+            SentReminder.objects.create(entry=entry, rule='day', version=0)
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_chunked_delete(self):
+        """
+        Make sure old entries are deleted a chunk at a time, with progress
+        reports, along with their related rows.
+        """
+        self.create_old_entries(5)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('clean_entries', '-b=2012-07-01', '--chunk=2')
+        self.assertEqual(
+            output.getvalue(),
+            'Cleaning 5 entries prior to 2012-07-01 ... '
+            '2/5 ... 4/5 ... 5/5 ... Done\n',
+        )
+        self.assertFalse(Entry.objects.exists())
+        self.assertFalse(SentReminder.objects.exists())
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_dry_run(self):
+        """
+        Make sure a dry run only counts the entries.
+        """
+        self.create_old_entries(3)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), self.assertNumQueries(1):
+            call_command('clean_entries', '-a=5', '--dry-run')
+        self.assertEqual(
+            output.getvalue(),
+            'Would clean 3 entries older than 5 years ... Done\n',
+        )
+        self.assertEqual(Entry.objects.count(), 3)
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_finished_emails_cleaned(self):
+        """
+        Make sure old emails that were sent or given up are cleaned out, but
+        not those still queued or more recent.
+        """
+        old = timezone.now() - datetime.timedelta(days=365 * 9)
+        for subject, sent, attempts, created in (
+            ('sent', old, 1, old),
+            ('given up', None, settings.DIARY_EMAIL_ATTEMPTS, old),
+            ('queued', None, 1, old),
+            ('recent', timezone.now(), 1, timezone.now()),
+        ):
+            email = outbox.enqueue(subject, 'body', 'diary@example.com', ['a'])
+            OutboundEmail.objects.filter(pk=email.pk).update(
+                sent=sent,
+                attempts=attempts,
+                created=created,
+            )
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('clean_entries', '-a=8')
+        self.assertEqual(
+            sorted(OutboundEmail.objects.values_list('subject', flat=True)),
+            ['queued', 'recent'],
+        )
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_archive_and_restore(self):
+        """
+        Make sure archived entries carry their related details, are deleted,
+        and can be restored once with their original primary keys and times.
+        """
+        customer = create_customer('archie')
+        resource = create_resource('Room 1', 'the old room')
+        treatment = create_treatment(
+            'Massage', datetime.timedelta(minutes=30), True,
+        )
+        self.create_old_entries(3)
+        booked = timezone.make_aware(datetime.datetime(2009, 12, 1, 9))
+        Entry.objects.update(
+            customer=customer,
+            resource=resource,
+            treatment=treatment,
+            created=booked,
+            edited=booked + datetime.timedelta(days=1),
+        )
+        pks = list(Entry.objects.order_by('pk').values_list('pk', flat=True))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'entries.jsonl.gz')
+            with contextlib.redirect_stdout(io.StringIO()):
+                call_command(
+                    'clean_entries', '-b=2012-07-01', '--chunk=2',
+                    '--archive', path,
+                )
+            self.assertFalse(Entry.objects.exists())
+            records = list(archive.records(path))
+            self.assertEqual([record['pk'] for record in records], pks)
+            self.assertEqual(records[0]['customer']['pk'], customer.pk)
+            self.assertEqual(
+                records[0]['customer']['email'], 'archie@example.com',
+            )
+            self.assertEqual(records[0]['resource']['name'], 'Room 1')
+            self.assertEqual(records[0]['treatment']['name'], 'Massage')
+
+            # the resource has gone since, so is recreated
+            resource.delete()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                call_command('restore_entries', path, '--chunk=2')
+            self.assertEqual(
+                output.getvalue(),
+                'Restoring entries from {0} ... '
+                '3 restored, 0 skipped ... Done\n'.format(path),
+            )
+            entries = Entry.objects.order_by('pk')
+            self.assertEqual([entry.pk for entry in entries], pks)
+            self.assertEqual(entries[0].customer, customer)
+            self.assertEqual(entries[0].treatment, treatment)
+            self.assertEqual(entries[0].resource.name, 'Room 1')
+            self.assertFalse(entries[0].resource.enabled)
+            self.assertEqual(entries[0].date, datetime.date(2010, 1, 1))
+            self.assertEqual(entries[0].end_time, t(11))
+            self.assertEqual(entries[0].created, booked)
+            self.assertEqual(
+                entries[0].edited, booked + datetime.timedelta(days=1),
+            )
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                call_command('restore_entries', path)
+            self.assertIn('0 restored, 3 skipped', output.getvalue())
+            self.assertEqual(Entry.objects.count(), 3)
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_restore_into_cold_storage(self):
+        """
+        Make sure archived entries older than the cold storage date are
+        restored as historic entries, and never restored twice.
+        """
+        self.create_old_entries(3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'entries.jsonl.gz')
+            with contextlib.redirect_stdout(io.StringIO()):
+                call_command(
+                    'clean_entries', '-b=2012-07-01', '--archive', path,
+                )
+                call_command('restore_entries', path, '-b=2010-01-03')
+            self.assertEqual(
+                list(HistoricEntry.objects.order_by('date').values_list(
+                    'date', flat=True,
+                )),
+                [datetime.date(2010, 1, 1), datetime.date(2010, 1, 2)],
+            )
+            self.assertEqual(
+                list(Entry.objects.values_list('date', flat=True)),
+                [datetime.date(2010, 1, 3)],
+            )
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                call_command('restore_entries', path)
+            self.assertIn('0 restored, 3 skipped', output.getvalue())
+
+            # by default, entries beyond the scheduled cold storage age
+            Entry.objects.all().delete()
+            HistoricEntry.objects.all().delete()
+            with mock.patch.object(settings, 'DIARY_HISTORIC_AGE', 10), \
+                contextlib.redirect_stdout(io.StringIO()):
+                call_command('restore_entries', path)
+            self.assertEqual(HistoricEntry.objects.count(), 3)
+            self.assertFalse(Entry.objects.exists())
+
+
+
+class HistoricEntryTests(TestCase):
+    """
+    Tests of moving old entries into cold storage, and reading them back.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer('test')
+        self.treatment = create_treatment(
+            'Massage', datetime.timedelta(minutes=30), False,
+        )
+
+
+    def create_dated_entry(self, date, notes):
+        entry = create_entry(date, t(10), datetime.timedelta(hours=1), notes)
+        entry.customer = self.customer
+        entry.treatment = self.treatment
+        entry.save()
+        return entry
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_move_in_chunks(self):
+        """
+        Make sure old entries are moved whole, with their primary keys, a
+        chunk at a time, and newer entries are left alone.
+        """
+        old = [
+            self.create_dated_entry(datetime.date(2010, 1, day), 'old')
+            for day in range(1, 6)
+        ]
+        new = self.create_dated_entry(datetime.date(2020, 6, 1), 'new')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('move_historic_entries', '-b=2012-07-01', '--chunk=2')
+        self.assertEqual(
+            output.getvalue(),
+            'Moving 5 entries prior to 2012-07-01 ... '
+            '2/5 ... 4/5 ... 5/5 ... Done\n',
+        )
+        self.assertEqual(list(Entry.objects.all()), [new])
+        moved = HistoricEntry.objects.order_by('pk')
+        self.assertEqual([entry.pk for entry in moved], [e.pk for e in old])
+        self.assertEqual(moved[0].created, old[0].created)
+        self.assertEqual(moved[0].end_time, t(11))
+        self.assertEqual(moved[0].customer, self.customer)
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_dry_run(self):
+        """
+        Make sure a dry run only counts the entries.
+        """
+        self.create_dated_entry(datetime.date(2010, 1, 1), 'old')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('move_historic_entries', '-a=5', '--dry-run')
+        self.assertEqual(
+            output.getvalue(),
+            'Would move 1 entry older than 5 years ... Done\n',
+        )
+        self.assertFalse(HistoricEntry.objects.exists())
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_history_reads_both(self):
+        """
+        Make sure the customer history and statistics include historic
+        entries, most recent first, but don't offer them for editing.
+        """
+        old = self.create_dated_entry(datetime.date(2010, 1, 1), 'old')
+        cancelled = self.create_dated_entry(datetime.date(2011, 1, 1), 'gone')
+        cancelled.cancelled = True
+        cancelled.save()
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('move_historic_entries', '-b=2012-07-01')
+        new = self.create_dated_entry(datetime.date(2020, 6, 1), 'new')
+
+        entries, key = historic.customer_page(
+            self.customer, datetime.date(2020, 7, 1), 10,
+        )
+        self.assertEqual(
+            [entry.pk for entry in entries],
+            [new.pk, cancelled.pk, old.pk],
+        )
+        self.assertIsNone(key)
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        response = self.client.get(
+            reverse('diary:history', kwargs={'pk': self.customer.pk}),
+        )
+        self.assertEqual(len(response.context['entries']), 3)
+        statistics = response.context['statistics']
+        self.assertEqual(statistics.total, 3)
+        self.assertEqual(statistics.cancelled, 1)
+        self.assertContains(
+            response, reverse('diary:entry_modal', kwargs={'pk': new.pk}),
+        )
+        self.assertNotContains(
+            response, reverse('diary:entry_modal', kwargs={'pk': old.pk}),
+        )
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_month_statistics_include_historic(self):
+        """
+        Make sure staff month statistics count recent and historic entries
+        together.
+        """
+        self.create_dated_entry(datetime.date(2010, 1, 4), 'historic')
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('move_historic_entries', '-b=2012-07-01')
+        cancelled = self.create_dated_entry(datetime.date(2010, 1, 4), 'new')
+        cancelled.cancelled = True
+        cancelled.save()
+        self.create_dated_entry(datetime.date(2010, 1, 5), 'recent')
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        response = self.client.get(
+            reverse('diary:month', kwargs={'year': 2010, 'month': 1}),
+        )
+        statistics = {
+            day[0]: day[3]
+            for week in response.context['weeks']
+            for day in week
+            if day[3]
+        }
+        self.assertEqual(
+            (statistics[4].total, statistics[4].cancelled), (2, 1),
+        )
+        self.assertEqual(statistics[5].total, 1)
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_customer_month_includes_historic(self):
+        """
+        Make sure customers see their historic entries in the month, in time
+        order with their recent ones and without links to edit them.
+        """
+        old = self.create_dated_entry(datetime.date(2010, 1, 4), 'historic')
+        old.time = datetime.time(11)
+        old.save()
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('move_historic_entries', '-b=2012-07-01')
+        new = self.create_dated_entry(datetime.date(2010, 1, 4), 'new')
+        self.client.force_login(self.customer, backend=MODEL_BACKEND)
+        response = self.client.get(
+            reverse('diary:month', kwargs={'year': 2010, 'month': 1}),
+        )
+        days = {
+            n: entries
+            for week in response.context['weeks']
+            for n, nav_slug, entries, statistics, current in week
+            if n
+        }
+        self.assertEqual(
+            [(type(entry), entry.pk) for entry in days[4]],
+            [(Entry, new.pk), (HistoricEntry, old.pk)],
+        )
+        self.assertContains(
+            response, reverse('diary:entry_modal', kwargs={'pk': new.pk}),
+        )
+        self.assertNotContains(
+            response, reverse('diary:entry_modal', kwargs={'pk': old.pk}),
+        )
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_clean_historic(self):
+        """
+        Make sure clean_entries cleans out historic entries too.
+        """
+        self.create_dated_entry(datetime.date(2010, 1, 1), 'historic')
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('move_historic_entries', '-b=2012-07-01')
+        self.create_dated_entry(datetime.date(2010, 1, 2), 'recent')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('clean_entries', '-b=2012-07-01')
+        self.assertEqual(
+            output.getvalue(),
+            'Cleaning 2 entries prior to 2012-07-01 ... 1/2 ... 2/2 ... Done\n',
+        )
+        self.assertFalse(Entry.objects.exists())
+        self.assertFalse(HistoricEntry.objects.exists())
+
+
+
+class HistoryPaginationTests(TestCase):
+    """
+    Tests of the customer history, paged by (date, time, pk) keys across
+    recent and historic entries.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        self.customer = create_customer('test')
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+
+
+    def create_history(self):
+        """
+        Make a history of 7 entries, the last two cancelled and at the same
+        time, and the oldest 4 in cold storage. Returns the notes of the
+        entries, most recent first.
+        """
+        notes = []
+        for day in range(1, 8):
+            entry = create_entry(
+                datetime.date(2010, 1, day if day < 7 else 6),
+                t(10),
+                datetime.timedelta(hours=1),
+                'visit {0}'.format(day),
+            )
+            entry.customer = self.customer
+            entry.cancelled = day >= 6
+            entry.save()
+            notes.append(entry.notes)
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('move_historic_entries', '-b=2010-01-05')
+        return list(reversed(notes))
+
+
+    @freeze_time('2020-07-01 12:00:00')
+    def test_pages(self):
+        """
+        Make sure the pages follow on from each other in order, with the
+        statistics for the whole history, and each page costs the same.
+        """
+        notes = self.create_history()
+        with mock.patch.object(settings, 'DIARY_HISTORY_PAGE', 3):
+            response = self.client.get(
+                reverse('diary:history', kwargs={'pk': self.customer.pk}),
+            )
+            seen = [entry.notes for entry in response.context['entries']]
+            self.assertEqual(response.context['statistics'].total, 7)
+            self.assertEqual(response.context['statistics'].cancelled, 2)
+            url = response.context['next_page']
+            self.assertContains(response, 'data-next="{0}"'.format(url))
+
+            queries = []
+            while url:
+                with CaptureQueriesContext(connection) as context:
+                    data = self.client.get(url).json()
+                queries.append(len(context))
+                seen += sorted(
+                    [note for note in notes if note in data['html']],
+                    key=data['html'].index,
+                )
+                url = data['next']
+        self.assertEqual(seen, notes)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(queries[0], queries[1])
+
+
+    def test_bad_cursor(self):
+        """
+        Make sure a malformed cursor is refused.
+        """
+        url = reverse('diary:history_entries', kwargs={'pk': self.customer.pk})
+        for cursor in ('nonsense', '2010-01-01_10:00:00', '2010-13-01_10:00_1'):
+            response = self.client.get(url, {'before': cursor})
+            self.assertEqual(response.status_code, 400)
+
+
+
+class StatisticsTests(TestCase):
+    """
+    Tests of entry statistics, counted in the database or in Python.
+    """
+
+
+    def create_entries(self):
+        date = datetime.date(2015, 10, 12)
+        duration = datetime.timedelta(minutes=30)
+        for hour, cancelled, no_show in (
+            (10, False, False),
+            (11, True, False),
+            (12, False, True),
+            (13, False, False),
+        ):
+            entry = create_entry(date, t(hour), duration, 'stats')
+            entry.cancelled = cancelled
+            entry.no_show = no_show
+            entry.save()
+
+
+    def test_queryset_statistics_in_one_query(self):
+        """
+        Make sure a queryset's statistics come from one aggregate query.
+        """
+        self.create_entries()
+        with self.assertNumQueries(1):
+            statistics = views.get_statistics(
+                Entry.objects.order_by('date', 'time'),
+            )
+        self.assertEqual(
+            (
+                statistics.total,
+                statistics.bookings,
+                statistics.cancelled,
+                statistics.no_show,
+            ),
+            (4, 2, 1, 1),
+        )
+        self.assertEqual(
+            Entry.objects.none().statistics(),
+            {'total': 0, 'cancelled': 0, 'no_show': 0},
+        )
+
+
+    def test_lists_and_combinations(self):
+        """
+        Make sure lists still work, and several sets are counted together.
+        """
+        self.create_entries()
+        entries = list(Entry.objects.all())
+        statistics = views.get_statistics(entries)
+        self.assertEqual((statistics.total, statistics.bookings), (4, 2))
+        statistics = views.get_statistics(
+            entries[:1],
+            Entry.objects.filter(cancelled=True),
+        )
+        self.assertEqual((statistics.total, statistics.cancelled), (2, 1))
+        self.assertIsNone(views.get_statistics([]))
+        self.assertIsNone(views.get_statistics(Entry.objects.none()))
+
+
+
+class DiaryGridTests(TestCase):
+    """
+    Tests of the diary grid shared by the day and multi-day views.
+    """
+
+
+    def test_entries_bucketed_in_one_query(self):
+        """
+        Make sure the entries for a range of days are fetched in one query and
+        each lands in the cell for its date and time slot.
+        """
+        date = datetime.date(2015, 10, 12)
+        duration = datetime.timedelta(minutes=30)
+        startTime = views.TIME_SLOTS[1][2]
+        for n in range(3):
+            day = date + datetime.timedelta(days=n)
+            create_entry(day, startTime, duration, 'slot {0}'.format(n)).save()
+        create_entry(
+            date + datetime.timedelta(days=2),
+            views.TIME_SLOTS[-1][2],
+            duration,
+            'last slot',
+        ).save()
+
+        user = obtain_superuser()
+        with self.assertNumQueries(1):
+            grid = DiaryGrid(date, 3, views.TIME_SLOTS, user)
+
+        self.assertEqual(len(grid.rows), len(views.TIME_SLOTS))
+        for n in range(3):
+            self.assertEqual(
+                [entry.notes for entry in grid.rows[1][1][n].entries],
+                ['slot {0}'.format(n)],
+            )
+        self.assertEqual(
+            [entry.notes for entry in grid.rows[-1][1][2].entries],
+            ['last slot'],
+        )
+        self.assertEqual(
+            sum(len(cell.entries) for slot, cells in grid for cell in cells),
+            4,
+        )
+
+
+    def test_entries_outside_time_slots_not_displayed(self):
+        """
+        Entries before the first or after the last time slot are left out.
+        """
+        date = datetime.date(2015, 10, 12)
+        duration = datetime.timedelta(minutes=30)
+        create_entry(
+            date,
+            change_time(date, views.TIME_SLOTS[0][2], -duration),
+            duration,
+            'too early',
+        ).save()
+        create_entry(date, views.TIME_SLOTS[-1][3], duration, 'too late').save()
+
+        grid = DiaryGrid(date, 1, views.TIME_SLOTS, obtain_superuser())
+        self.assertEqual(
+            sum(len(cell.entries) for slot, cells in grid for cell in cells),
+            0,
+        )
+
+
+    @freeze_time('2015-10-12 12:00:00')
+    @freeze_time('2015-10-12 10:10:00')  # 11:10 in London
+    def test_business_logic_flags(self):
+        """
+        Make sure the cells carry the business logic flags for their slot and
+        date, relative to the current time.
+        """
+        today = datetime.date(2015, 10, 12)
+        tomorrow = today + datetime.timedelta(days=1)
+        grid = DiaryGrid(today, 2, views.TIME_SLOTS, obtain_superuser())
+        flags = {
+            (cell.date, timeSlot[2]): (
+                cell.current,
+                cell.trading,
+                cell.historic,
+                cell.before_advance,
+                cell.allow_dnd,
+            )
+            for timeSlot, cells in grid
+            for cell in cells
+        }
+        # (current, trading, historic, before_advance, allow_dnd)
+        self.assertEqual(
+            flags[(today, t(10, 30))], (False, True, True, True, False),
+        )
+        self.assertEqual(
+            flags[(today, t(11))], (True, True, False, True, False),
+        )
+        self.assertEqual(
+            flags[(tomorrow, t(11))], (False, True, False, False, True),
+        )
+        self.assertEqual(
+            flags[(tomorrow, t(6))], (False, False, False, False, False),
+        )
+
+
+    def test_no_shows_left_out_for_customers(self):
+        """
+        Customers never see no-show entries so they are not fetched for them.
+        """
+        date = datetime.date(2015, 10, 12)
+        entry = create_entry(
+            date,
+            views.TIME_SLOTS[1][2],
+            datetime.timedelta(minutes=30),
+            'no show',
+        )
+        entry.no_show = True
+        entry.save()
+
+        staffGrid = DiaryGrid(date, 1, views.TIME_SLOTS, obtain_superuser())
+        customerGrid = DiaryGrid(
+            date, 1, views.TIME_SLOTS, create_customer('test'),
+        )
+        self.assertEqual(len(staffGrid.rows[1][1][0].entries), 1)
+        self.assertEqual(len(customerGrid.rows[1][1][0].entries), 0)
+
+
+    def count_view_queries(self, url):
+        """
+        Count the queries made rendering a diary view.
+        """
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+
+    def test_view_queries_independent_of_entries(self):
+        """
+        The day and multi-day views make the same number of queries however
+        many entries and days they display.
+        """
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        date = datetime.date(2015, 10, 12)
+        slug = date.strftime(views.DATE_SLUG_FORMAT)
+        dayUrl = reverse('diary:day', kwargs={'slug': slug})
+        multiDayUrl = reverse('diary:multi_day', kwargs={'slug': slug})
+        emptyDay = self.count_view_queries(dayUrl)
+        emptyMultiDay = self.count_view_queries(multiDayUrl)
+
+        duration = datetime.timedelta(minutes=30)
+        for n in range(settings.DIARY_MULTI_DAY_NUMBER):
+            day = date + datetime.timedelta(days=n)
+            for timeLabel, timeSlug, startTime, endTime in views.TIME_SLOTS:
+                create_entry(day, startTime, duration, 'busy').save()
+
+        self.assertEqual(self.count_view_queries(dayUrl), emptyDay)
+        self.assertEqual(self.count_view_queries(multiDayUrl), emptyMultiDay)
+
+
+class MonthViewTests(TestCase):
+    """
+    Tests of the month view and the per-day statistics behind it.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def create_month_entries(self):
+        """
+        Make a few entries on two days of October 2015.
+        """
+        duration = datetime.timedelta(minutes=30)
+        day1 = datetime.date(2015, 10, 5)
+        day2 = datetime.date(2015, 10, 20)
+        create_entry(day1, datetime.time(9), duration, 'booked').save()
+        cancelled = create_entry(day1, datetime.time(10), duration, 'cancelled')
+        cancelled.cancelled = True
+        cancelled.save()
+        no_show = create_entry(day1, datetime.time(11), duration, 'no show')
+        no_show.no_show = True
+        no_show.save()
+        create_entry(day2, datetime.time(9), duration, 'booked').save()
+        return day1, day2
+
+
+    def test_daily_statistics(self):
+        """
+        Make sure the grouped statistics count each day correctly.
+        """
+        day1, day2 = self.create_month_entries()
+        with self.assertNumQueries(1):
+            daily = Entry.objects.all().daily_statistics()
+        self.assertEqual(
+            daily,
+            {
+                day1: {'total': 3, 'cancelled': 1, 'no_show': 1},
+                day2: {'total': 1, 'cancelled': 0, 'no_show': 0},
+            },
+        )
+
+
+    def test_staff_month_statistics(self):
+        """
+        Staff see the statistics for each day, using a fixed number of queries.
+        """
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        url = reverse('diary:month', kwargs={'year': 2015, 'month': 10})
+        with CaptureQueriesContext(connection) as emptyContext:
+            self.client.get(url)
+
+        day1, day2 = self.create_month_entries()
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(
+            len(context.captured_queries),
+            len(emptyContext.captured_queries),
+        )
+
+        statistics = {
+            day: statistics
+            for week in response.context['weeks']
+            for day, nav_slug, entries, statistics, current in week
+            if day
+        }
+        self.assertEqual(
+            (
+                statistics[day1.day].total,
+                statistics[day1.day].bookings,
+                statistics[day1.day].cancelled,
+                statistics[day1.day].no_show,
+            ),
+            (3, 1, 1, 1),
+        )
+        self.assertEqual(statistics[day2.day].total, 1)
+        self.assertIsNone(statistics[1])
+
+
+    def test_customer_month_entries(self):
+        """
+        Customers see only their own uncancelled entries, on the right days,
+        using a fixed number of queries.
+        """
+        customer = create_customer('test')
+        other = Customer.objects.create(username='other', password='random')
+        self.client.force_login(customer, backend=MODEL_BACKEND)
+        url = reverse('diary:month', kwargs={'year': 2015, 'month': 10})
+        with CaptureQueriesContext(connection) as emptyContext:
+            self.client.get(url)
+
+        duration = datetime.timedelta(minutes=30)
+        day = datetime.date(2015, 10, 5)
+        for hour, owner, cancelled in (
+            (11, customer, False),
+            (9, customer, False),
+            (10, customer, True),
+            (12, other, False),
+        ):
+            entry = create_entry(day, datetime.time(hour), duration, 'entry')
+            entry.customer = owner
+            entry.cancelled = cancelled
+            entry.save()
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(
+            len(context.captured_queries),
+            len(emptyContext.captured_queries),
+        )
+
+        days = {
+            n: entries
+            for week in response.context['weeks']
+            for n, nav_slug, entries, statistics, current in week
+            if n
+        }
+        self.assertEqual(
+            [entry.time.hour for entry in days[day.day]],
+            [9, 11],
+        )
+        self.assertEqual(days[1], [])
+
+
+class YearOccupancyTests(TestCase):
+    """
+    Tests of the cached month occupancy behind the year view.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def test_occupancy_in_one_query(self):
+        """
+        Make sure the occupied months of a range of years are found in one
+        query each on recent and historic entries, and come from the cache
+        afterwards.
+        """
+        duration = datetime.timedelta(hours=1)
+        for date in (
+            datetime.date(2014, 1, 31),
+            datetime.date(2015, 10, 1),
+            datetime.date(2015, 12, 31),
+            datetime.date(2017, 1, 1),
+        ):
+            create_entry(date, datetime.time(12), duration, 'entry').save()
+        historic.move_historic(
+            Entry.objects.filter(date__lt=datetime.date(2015, 1, 1)), 10,
+        )
+
+        with self.assertNumQueries(2):
+            bitmaps = occupancy(2014, 2016)
+        self.assertEqual(
+            bitmaps,
+            {2014: 1, 2015: (1 << 9) | (1 << 11), 2016: 0},
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(occupancy(2014, 2016), bitmaps)
+
+
+    def test_occupancy_invalidated_by_changes(self):
+        """
+        Saving, moving or deleting an entry refreshes the years it touches.
+        """
+        entry = create_entry(
+            datetime.date(2015, 10, 1),
+            datetime.time(12),
+            datetime.timedelta(hours=1),
+            'entry',
+        )
+        self.assertEqual(occupancy(2014, 2016)[2015], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            entry.save()
+        self.assertEqual(occupancy(2014, 2016)[2015], 1 << 9)
+
+        entry = Entry.objects.get(pk=entry.pk)
+        entry.date = datetime.date(2016, 2, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            entry.save()
+        self.assertEqual(
+            occupancy(2014, 2016),
+            {2014: 0, 2015: 0, 2016: 1 << 1},
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            entry.delete()
+        self.assertEqual(occupancy(2014, 2016)[2016], 0)
+
+
+    def test_occupancy_invalidated_on_commit(self):
+        """
+        The cache is only invalidated when the transaction saving an entry
+        commits, so it can't be refilled with data from before the change.
+        """
+        entry = create_entry(
+            datetime.date(2015, 10, 1),
+            datetime.time(12),
+            datetime.timedelta(hours=1),
+            'entry',
+        )
+        self.assertEqual(occupancy(2014, 2016)[2015], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                entry.save()
+                self.assertEqual(occupancy(2014, 2016)[2015], 0)
+            self.assertEqual(occupancy(2014, 2016)[2015], 0)
+        self.assertEqual(occupancy(2014, 2016)[2015], 1 << 9)
+
+
+    def test_year_view(self):
+        """
+        The year view flags the months with entries.
+        """
+        create_entry(
+            datetime.date(2015, 10, 1),
+            datetime.time(12),
+            datetime.timedelta(hours=1),
+            'entry',
+        ).save()
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        response = self.client.get(reverse('diary:year', kwargs={'year': 2015}))
+        flagged = [
+            (year, month['n'])
+            for year, months in response.context['years']
+            for month in months if month['entry']
+        ]
+        self.assertEqual(flagged, [(2015, 10)])
+
+
+class RemindersTests(TestCase):
+    """
+    Tests of the cached reminder sidebar data.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def create_reminder(self, date, time, customer=None):
+        """
+        Make and save an entry for the reminders.
+        """
+        entry = create_entry(
+            date,
+            time,
+            datetime.timedelta(hours=1),
+            'reminder',
+        )
+        entry.customer = customer
+        entry.save()
+        return entry
+
+
+    @freeze_time('2015-10-12 10:00:00')
+    def test_reminders_cached(self):
+        """
+        Make sure reminders are only fetched once while nothing changes.
+        """
+        today, now = get_today_now()
+        user = obtain_superuser()
+        self.create_reminder(today, datetime.time(15))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(caching.reminders(user)), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(caching.reminders(user)), 1)
+
+
+    @freeze_time('2015-10-12 10:00:00')
+    def test_customer_reminders(self):
+        """
+        Customers only see their own uncancelled entries, without an extra
+        customer lookup.
+        """
+        today, now = get_today_now()
+        tomorrow = today + datetime.timedelta(days=1)
+        customer = create_customer('test')
+        other = Customer.objects.create(username='other', password='random')
+        self.create_reminder(today, datetime.time(15), customer)
+        self.create_reminder(tomorrow, datetime.time(9), other)
+        cancelled = self.create_reminder(tomorrow, datetime.time(15), customer)
+        cancelled.cancelled = True
+        cancelled.save()
+
+        user = User.objects.get(pk=customer.pk)
+        with self.assertNumQueries(1):
+            entries = caching.reminders(user)
+        self.assertEqual([entry.customer for entry in entries], [customer])
+
+
+    @freeze_time('2015-10-12 10:00:00')
+    def test_evicted_generation(self):
+        """
+        Make sure reminders cached before the generation key is evicted are
+        not served again.
+        """
+        today, now = get_today_now()
+        user = obtain_superuser()
+        self.assertEqual(caching.reminders(user), [])
+        self.create_reminder(today, datetime.time(15))
+        cache.delete(caching.REMINDERS_GENERATION_KEY)
+        self.assertEqual(len(caching.reminders(user)), 1)
+
+
+    def test_reminders_invalidated_by_entry_changes(self):
+        """
+        Changing entries for today or tomorrow refreshes the reminders, other
+        changes do not.
+        """
+        with freeze_time('2015-10-12 10:00:00'):
+            today, now = get_today_now()
+            user = obtain_superuser()
+            self.assertEqual(caching.reminders(user), [])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                entry = self.create_reminder(
+                    today + datetime.timedelta(days=7),
+                    datetime.time(15),
+                )
+            with self.assertNumQueries(0):
+                self.assertEqual(caching.reminders(user), [])
+
+            entry.date = today + datetime.timedelta(days=1)
+            with self.captureOnCommitCallbacks(execute=True):
+                entry.save()
+            self.assertEqual(caching.reminders(user), [entry])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                entry.delete()
+            self.assertEqual(caching.reminders(user), [])
+
+
+    def test_reminders_expire_when_entry_starts(self):
+        """
+        Today's entries drop off the reminders once they start.
+        """
+        with freeze_time('2015-10-12 10:00:00') as frozen:
+            today, now = get_today_now()
+            user = obtain_superuser()
+            self.create_reminder(
+                today,
+                change_time(today, now, datetime.timedelta(hours=1)),
+            )
+            self.assertEqual(len(caching.reminders(user)), 1)
+
+            frozen.tick(datetime.timedelta(minutes=59))
+            with self.assertNumQueries(0):
+                self.assertEqual(len(caching.reminders(user)), 1)
+
+            frozen.tick(datetime.timedelta(minutes=2))
+            self.assertEqual(caching.reminders(user), [])
+
+
+class OverlapQueryTests(TestCase):
+    """
+    Tests of the database-side overlap detection used by entry validation.
+    """
+
+
+    def setUp(self):
+        self.date = datetime.date(2015, 10, 12)
+        self.resource = create_resource('resource', 'resource')
+        booked = create_entry(
+            self.date,
+            datetime.time(hour=12),
+            datetime.timedelta(hours=1),
+            'booked',
+        )
+        booked.resource = self.resource
+        booked.save()
+
+
+    def candidate(self, time, duration):
+        """
+        Make an unsaved entry using the resource on the same day.
+        """
+        entry = create_entry(self.date, time, duration, 'candidate')
+        entry.resource = self.resource
+        return entry
+
+
+    def test_overlap_matches_entry_equality(self):
+        """
+        Make sure the database agrees with Entry.__eq__() about overlaps.
+        """
+        booked = Entry.objects.get()
+        for hour, minute, duration, overlaps in (
+            (11, 0, datetime.timedelta(hours=1), False),    # ends at start
+            (11, 30, datetime.timedelta(hours=1), True),    # ends inside
+            (12, 0, datetime.timedelta(hours=0), True),     # same start
+            (12, 15, datetime.timedelta(minutes=15), True), # enveloped
+            (11, 0, datetime.timedelta(hours=3), True),     # envelops
+            (12, 45, datetime.timedelta(hours=1), True),    # starts inside
+            (13, 0, datetime.timedelta(hours=1), False),    # starts at end
+        ):
+            entry = self.candidate(datetime.time(hour, minute), duration)
+            self.assertEqual(entry == booked, overlaps)
+            self.assertEqual(
+                Entry.objects.overlapping(entry).exists(),
+                overlaps,
+            )
+
+
+    def test_resource_conflict_check_is_one_query(self):
+        """
+        The resource conflict check costs one query however busy the day is.
+        """
+        for hour in range(14, 20):
+            entry = self.candidate(
+                datetime.time(hour),
+                datetime.timedelta(hours=1),
+            )
+            entry.save()
+
+        entry = self.candidate(
+            datetime.time(hour=12, minute=30),
+            datetime.timedelta(hours=1),
+        )
+        with self.assertNumQueries(1):
+            self.assertRaisesMessage(
+                ValidationError,
+                'Resource clash with another Entry. '
+                'Please change resource or time.',
+                entry.validateNoResourceConflicts,
+            )
+
+
+    def test_customer_double_booking_check_is_one_query(self):
+        """
+        The customer double booking check costs one query.
+        """
+        customer = create_customer('test')
+        booked = Entry.objects.get()
+        booked.customer = customer
+        booked.save()
+
+        entry = create_entry(
+            self.date,
+            datetime.time(hour=12, minute=30),
+            datetime.timedelta(hours=1),
+            'candidate',
+        )
+        entry.customer = customer
+        with self.assertNumQueries(1):
+            self.assertRaisesMessage(
+                ValidationError,
+                'Double booking is not allowed. Please choose another time.',
+                entry.validateCustomerNotDoubleBooked,
+            )
+
+
+    def test_conflicts_checked_together(self):
+        """
+        Resource and customer clashes are found in one round trip, with a
+        resource clash taking precedence.
+        """
+        customer = create_customer('test')
+        other = create_entry(
+            self.date,
+            datetime.time(hour=15),
+            datetime.timedelta(hours=1),
+            'customer booking',
+        )
+        other.customer = customer
+        other.save()
+
+        entry = self.candidate(
+            datetime.time(hour=12, minute=30),
+            datetime.timedelta(hours=3),
+        )
+        entry.customer = customer
+        with self.assertNumQueries(1):
+            self.assertRaisesMessage(
+                ValidationError,
+                'Resource clash with another Entry. '
+                'Please change resource or time.',
+                entry.validateNoConflicts,
+            )
+
+        entry.time = datetime.time(hour=14)
+        with self.assertNumQueries(1):
+            self.assertRaisesMessage(
+                ValidationError,
+                'Double booking is not allowed. Please choose another time.',
+                entry.validateNoConflicts,
+            )
+
+        entry.time = datetime.time(hour=16)
+        with self.assertNumQueries(1):
+            entry.validateNoConflicts()
+
+
+class EndTimeTests(TestCase):
+    """
+    Tests of the stored entry end time.
+    """
+
+
+    def test_end_time_stored_on_save(self):
+        """
+        Make sure the end time is kept in step with the time and duration.
+        """
+        entry = create_entry(
+            datetime.date(2015, 10, 12),
+            datetime.time(hour=12),
+            datetime.timedelta(minutes=45),
+            'end time',
+        )
+        entry.save()
+        self.assertEqual(
+            Entry.objects.get(pk=entry.pk).end_time,
+            datetime.time(hour=12, minute=45),
+        )
+
+        entry.time = datetime.time(hour=14)
+        entry.duration = datetime.time(hour=2)
+        entry.save()
+        self.assertEqual(
+            Entry.objects.get(pk=entry.pk).end_time,
+            datetime.time(hour=16),
+        )
+
+
+    def test_end_time_clipped_at_midnight(self):
+        """
+        Entries running past midnight end at the end of the day.
+        """
+        entry = create_entry(
+            datetime.date(2015, 10, 12),
+            datetime.time(hour=23),
+            datetime.timedelta(hours=2),
+            'late',
+        )
+        entry.save()
+        self.assertEqual(entry.end_time, datetime.time.max)
+        self.assertEqual(entry.time_end(), datetime.time(hour=1))
+
+
+
+class EndTimeMigrationTests(TransactionTestCase):
+    """
+    Tests of the data migration filling in the end times of existing entries.
+    """
+
+    migrate_from = ('diary', '0010_resource_enabled_alter_resource_bg_color_and_more')
+    migrate_to = ('diary', '0011_entry_end_time')
+
+
+    def tearDown(self):
+        call_command('migrate', 'diary', verbosity=0)
+
+
+    def test_end_times_populated(self):
+        """
+        Make sure existing entries get their end times.
+        """
+        executor = MigrationExecutor(connection)
+        executor.migrate([self.migrate_from])
+        OldEntry = executor.loader.project_state(
+            self.migrate_from,
+        ).apps.get_model('diary', 'Entry')
+        date = datetime.date(2015, 10, 12)
+        OldEntry.objects.create(
+            date=date,
+            time=datetime.time(hour=9, minute=30),
+            duration=datetime.time(hour=1, minute=15),
+        )
+        OldEntry.objects.create(
+            date=date,
+            time=datetime.time(hour=23),
+            duration=datetime.time(hour=2),
+        )
+
+        executor = MigrationExecutor(connection)
+        executor.migrate([self.migrate_to])
+        NewEntry = executor.loader.project_state(
+            self.migrate_to,
+        ).apps.get_model('diary', 'Entry')
+        self.assertEqual(
+            list(NewEntry.objects.order_by('time').values_list(
+                'end_time',
+                flat=True,
+            )),
+            [datetime.time(hour=10, minute=45), datetime.time.max],
+        )
+
+
+class IndexUsageTests(TestCase):
+    """
+    Tests that the hot entry queries use the composite indexes on SQLite.
+    """
+
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('query plans are checked on SQLite')
+        self.date = datetime.date(2015, 10, 12)
+        self.entry = create_entry(
+            self.date,
+            datetime.time(hour=12),
+            datetime.timedelta(hours=1),
+            'indexed',
+        )
+        self.entry.resource = create_resource('resource', 'resource')
+        self.entry.customer = create_customer('test')
+
+
+    def assertUsesIndex(self, queryset, index):
+        """
+        Make sure the query plan for the queryset uses the index.
+        """
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+
+
+    def test_day_grid_uses_date_index(self):
+        grid = DiaryGrid(self.date, 3, views.TIME_SLOTS, obtain_superuser())
+        self.assertUsesIndex(grid.entries(), 'diary_entry_date_time_idx')
+
+
+    def test_resource_conflicts_use_resource_index(self):
+        self.assertUsesIndex(
+            self.entry.activeOverlaps().filter(
+                resource_id=self.entry.resource_id,
+            ),
+            'diary_entry_resource_idx',
+        )
+
+
+    def test_double_bookings_use_customer_index(self):
+        self.assertUsesIndex(
+            self.entry.activeOverlaps().filter(
+                customer_id=self.entry.customer_id,
+            ),
+            'diary_entry_customer_idx',
+        )
+
+
+    def test_combined_conflicts_use_both_indexes(self):
+        with CaptureQueriesContext(connection) as context:
+            self.entry.validateNoConflicts()
+        sql = context.captured_queries[0]['sql']
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            plan = '\n'.join(str(row) for row in cursor.fetchall())
+        self.assertIn('diary_entry_resource_idx', plan)
+        self.assertIn('diary_entry_customer_idx', plan)
+
+
+    def test_email_reminders_use_date_index(self):
+        """
+        The reminders actually sent search entries by date and time, and
+        never scan the table.
+        """
+        start = datetime.datetime.combine(self.date, datetime.time(hour=9))
+        plan = reminders.due(
+            'day', start, start + datetime.timedelta(hours=24),
+        ).explain()
+        self.assertIn(
+            'SEARCH diary_entry USING INDEX diary_entry_date_time_idx', plan,
+        )
+        self.assertNotIn('SCAN diary_entry', plan)
+
+
+def t(hour, minute=0):
+    """
+    Shorthand for a time of day.
+    """
+    return datetime.time(hour=hour, minute=minute)
+
+
+class OccupancyTests(TestCase):
+    """
+    Tests of the sorted interval occupancy of resources and customers.
+    """
+
+
+    def test_periods_merged(self):
+        """
+        Touching and overlapping periods merge into disjoint blocks.
+        """
+        occupancy = Occupancy([
+            (t(14), t(15)),
+            (t(9), t(10)),
+            (t(10), t(11)),
+            (t(10, 30), t(12)),
+        ])
+        self.assertEqual(
+            occupancy.blocks(),
+            [(t(9), t(12)), (t(14), t(15))],
+        )
+
+
+    def test_union(self):
+        """
+        Make sure a union is busy whenever either occupancy is.
+        """
+        occupancy = Occupancy([(t(9), t(10)), (t(14), t(15))]) | Occupancy(
+            [(t(9, 30), t(11)), (t(12), t(13))],
+        )
+        self.assertEqual(
+            occupancy.blocks(),
+            [(t(9), t(11)), (t(12), t(13)), (t(14), t(15))],
+        )
+        self.assertEqual((Occupancy() | Occupancy()).blocks(), [])
+
+
+    def test_next_gap(self):
+        """
+        Make sure the earliest gap long enough is found.
+        """
+        occupancy = Occupancy([
+            (t(9), t(10)),
+            (t(10, 30), t(11)),
+            (t(12), t(13)),
+        ])
+        hour = datetime.timedelta(hours=1)
+        self.assertEqual(occupancy.next_gap(t(8), hour), t(8))
+        self.assertEqual(occupancy.next_gap(t(9, 30), hour), t(11))
+        self.assertEqual(
+            occupancy.next_gap(t(9, 30), datetime.timedelta(minutes=30)),
+            t(10),
+        )
+        self.assertEqual(occupancy.next_gap(t(11, 30), hour), t(13))
+        self.assertIsNone(occupancy.next_gap(t(11, 30), hour, until=t(13, 30)))
+
+
+    def test_free_windows(self):
+        """
+        Make sure the free windows within opening hours are found.
+        """
+        occupancy = Occupancy([
+            (t(8), t(9, 30)),
+            (t(10), t(10, 15)),
+            (t(12), t(13)),
+            (t(16, 30), t(18)),
+        ])
+        self.assertEqual(
+            occupancy.free_windows(t(9), t(17)),
+            [(t(9, 30), t(10)), (t(10, 15), t(12)), (t(13), t(16, 30))],
+        )
+        self.assertEqual(
+            occupancy.free_windows(t(9), t(17), datetime.timedelta(hours=2)),
+            [(t(13), t(16, 30))],
+        )
+        self.assertEqual(
+            Occupancy().free_windows(t(9), t(17)),
+            [(t(9), t(17))],
+        )
+
+
+    def test_built_from_one_query(self):
+        """
+        A day's occupancy comes from one query and ignores cancellations and
+        the excluded entry.
+        """
+        date = datetime.date(2015, 10, 12)
+        resource = create_resource('resource', 'resource')
+        customer = create_customer('customer')
+        entries = []
+        for hour, cancelled in ((9, False), (11, True), (14, False)):
+            entry = create_entry(
+                date, t(hour), datetime.timedelta(hours=1), 'busy',
+            )
+            entry.resource = resource
+            entry.customer = customer if hour == 9 else None
+            entry.cancelled = cancelled
+            entry.save()
+            entries.append(entry)
+
+        with self.assertNumQueries(1):
+            occupancy = Occupancy.for_day(
+                date,
+                resource=resource,
+                exclude=entries[2],
+            )
+        self.assertEqual(occupancy.blocks(), [(t(9), t(10))])
+
+        with self.assertNumQueries(1):
+            occupancies, customerOccupancies = Occupancy.for_range(
+                date, date, [resource.pk], customer,
+            )
+        self.assertEqual(
+            occupancies[(resource.pk, date)].blocks(),
+            [(t(9), t(10)), (t(14), t(15))],
+        )
+        self.assertEqual(
+            customerOccupancies[date].blocks(),
+            [(t(9), t(10))],
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(Occupancy.for_range(date, date, []), ({}, {}))
+
+
+
+class AvailabilityTests(TestCase):
+    """
+    Tests of the availability search over resources and days.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        self.monday = datetime.date(2015, 10, 12)
+        self.sunday = datetime.date(2015, 10, 18)
+        self.couch = create_resource('couch', 'couch')
+        self.bath = create_resource('bath', 'bath')
+        self.massage = create_treatment(
+            'massage', datetime.timedelta(hours=1), True,
+        )
+        self.chat = create_treatment(
+            'chat', datetime.timedelta(minutes=30), False,
+        )
+        self.customer = create_customer('customer')
+        hour = datetime.timedelta(hours=1)
+        for hour_of_day, resource, customer, cancelled in (
+            (9, self.couch, None, False),
+            (12, self.couch, None, False),
+            (14, self.couch, None, True),           # cancelled don't count
+            (15, None, self.customer, False),
+        ):
+            entry = create_entry(self.monday, t(hour_of_day), hour, 'busy')
+            entry.resource = resource
+            entry.customer = customer
+            entry.cancelled = cancelled
+            entry.save()
+
+
+    def test_resource_windows(self):
+        """
+        A resource treatment fits around each resource's bookings, and a
+        customer's own bookings, within opening hours, from one bulk query.
+        """
+        with self.assertNumQueries(2):              # resources and bookings
+            windows = availability(
+                self.massage, self.monday, self.monday, self.customer,
+            )
+        self.assertEqual(windows, [
+            Window(self.monday, t(9), t(15), self.bath),
+            Window(self.monday, t(16), t(18), self.bath),
+            Window(self.monday, t(10), t(12), self.couch),
+            Window(self.monday, t(13), t(15), self.couch),
+            Window(self.monday, t(16), t(18), self.couch),
+        ])
+
+        # gaps shorter than the minimum duration are not offered
+        self.massage.min_duration = datetime.timedelta(hours=3)
+        self.assertEqual(
+            availability(self.massage, self.monday, self.monday),
+            [
+                Window(self.monday, t(9), t(18), self.bath),
+                Window(self.monday, t(13), t(18), self.couch),
+            ],
+        )
+
+
+    def test_no_resource_windows(self):
+        """
+        A treatment without a resource is only limited by opening hours and the
+        customer's bookings, day by day.
+        """
+        windows = availability(
+            self.chat,
+            self.monday,
+            self.sunday,
+            self.customer,
+            after=datetime.datetime.combine(self.sunday, t(12)),
+        )
+        self.assertEqual(windows, [Window(self.sunday, t(12), t(16, 30), None)])
+
+        windows = availability(self.chat, self.monday, self.monday, self.customer)
+        self.assertEqual(windows, [
+            Window(self.monday, t(9), t(15), None),
+            Window(self.monday, t(16), t(18), None),
+        ])
+
+
+    @freeze_time('2015-10-11 12:00:00')
+    def test_view(self):
+        """
+        The json endpoint gives staff any window in the range, and customers
+        only those they may book.
+        """
+        url = reverse('diary:availability', kwargs={
+            'treatment_pk': self.massage.pk,
+        })
+
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        response = self.client.get(url, {'start': '2015-10-11', 'end': '2015-10-12'})
+        data = response.json()
+        self.assertEqual(data['duration'], 60)
+        self.assertEqual(len(data['windows']), 5)
+        self.assertEqual(data['windows'][0], {
+            'date': '2015-10-11',
+            'start': '10-30',                       # sunday
+            'end': '16-30',
+            'resource': self.bath.pk,
+            'resource_name': 'bath',
+        })
+
+        response = self.client.get(url, {'start': '2015-10-12', 'end': '2015-12-12'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'start': 'tomorrow'})
+        self.assertEqual(response.status_code, 400)
+
+        # customers keep clear of their own bookings and book a day ahead
+        self.client.force_login(self.customer, backend=MODEL_BACKEND)
+        response = self.client.get(url, {'start': '2015-10-11', 'end': '2015-10-12'})
+        self.assertEqual(
+            [
+                (window['date'], window['start'], window['resource_name'])
+                for window in response.json()['windows']
+            ],
+            [
+                ('2015-10-12', '09-00', 'bath'),
+                ('2015-10-12', '16-00', 'bath'),
+                ('2015-10-12', '10-00', 'couch'),
+                ('2015-10-12', '13-00', 'couch'),
+                ('2015-10-12', '16-00', 'couch'),
+            ],
+        )
+
+
+class EntryUpdateTests(TestCase):
+    """
+    Tests of drag-and-drop rescheduling with slot fitting.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        self.date = datetime.date(2015, 10, 12)
+        self.couch = create_resource('couch', 'couch')
+        self.user = obtain_superuser()
+        self.client.force_login(self.user, backend=MODEL_BACKEND)
+        for start, minutes in ((t(10), 10), (t(10, 10), 5), (t(10, 25), 5)):
+            entry = create_entry(
+                self.date, start, datetime.timedelta(minutes=minutes), 'busy',
+            )
+            entry.resource = self.couch
+            entry.save()
+        self.entry = create_entry(
+            self.date, t(14), datetime.timedelta(minutes=10), 'moving',
+        )
+        self.entry.resource = self.couch
+        self.entry.save()
+
+
+    def drop(self, slug):
+        """
+        Drop the moving entry onto the slot with the datetime slug.
+        """
+        return self.client.post(
+            reverse('diary:entry_dnd'),
+            {'pk': self.entry.pk, 'slug': slug},
+        )
+
+
+    def test_fits_in_first_gap(self):
+        """
+        A clashing drop is placed in the first gap in the slot that fits.
+        """
+        response = self.drop('2015-10-12_10-00')
+        self.assertEqual(response.status_code, 200)
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.time, t(10, 15))
+
+
+    def test_no_gap_in_slot(self):
+        """
+        A drop that cannot be fitted in the slot is refused and not saved.
+        """
+        self.entry.duration = t(0, 15)
+        self.entry.save()
+        response = self.drop('2015-10-12_10-00')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Resource clash', response.json()['message'])
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.time, t(14))
+
+
+    def test_no_bookings_to_fit_around(self):
+        """
+        Entries without resource or customer can't clash, so there are no
+        bookings to fit around.
+        """
+        self.entry.resource = None
+        with self.assertNumQueries(0):
+            self.assertIsNone(views.fitInSlot(self.entry, self.date, t(10)))
+
+
+    def test_bounded_queries(self):
+        """
+        Fitting the entry takes a fixed number of queries.
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                views.fitInSlot(self.entry, self.date, t(10)),
+                t(10, 15),
+            )
+
+
+
+class BookingLockTests(TransactionTestCase):
+    """
+    Tests that concurrent conflicting bookings are serialised.
+    """
+
+    THREADS = 8
+
+
+    def setUp(self):
+        cache.clear()
+        self.date = datetime.date(2030, 10, 14)
+        self.couch = create_resource('couch', 'couch')
+        self.customer = create_customer('customer')
+        obtain_superuser()
+
+
+    def hammer(self, book):
+        """
+        Run book(n) in concurrent threads, released together. Returns the
+        number of bookings refused by validation.
+        """
+        barrier = threading.Barrier(self.THREADS)
+        refused = []
+        errors = []
+
+        def run(n):
+            try:
+                barrier.wait()
+                book(n)
+            except ValidationError:
+                refused.append(n)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=run, args=(n,))
+            for n in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return len(refused)
+
+
+    def test_no_resource_double_booking(self):
+        """
+        Overlapping bookings of one resource: exactly one gets through.
+        """
+        def book(n):
+            entry = create_entry(
+                self.date,
+                t(10, n),                           # all overlap
+                datetime.timedelta(minutes=30),
+                'race {0}'.format(n),
+            )
+            entry.resource = self.couch
+            entry.save()
+
+        refused = self.hammer(book)
+        self.assertEqual(refused, self.THREADS - 1)
+        self.assertEqual(
+            Entry.objects.filter(resource=self.couch, date=self.date).count(),
+            1,
+        )
+
+
+    def test_no_customer_double_booking(self):
+        """
+        Overlapping bookings of one customer: exactly one gets through.
+        """
+        def book(n):
+            entry = create_entry(
+                self.date,
+                t(10),
+                datetime.timedelta(minutes=30),
+                'race {0}'.format(n),
+            )
+            entry.customer_id = self.customer.pk
+            entry.save()
+
+        self.assertEqual(self.hammer(book), self.THREADS - 1)
+        self.assertEqual(
+            Entry.objects.filter(customer=self.customer).count(),
+            1,
+        )
+
+
+    def test_locks(self):
+        """
+        Only active entries take locks, in a fixed order, and lock rows are
+        reused.
+        """
+        entry = create_entry(
+            self.date, t(10), datetime.timedelta(minutes=30), 'locked',
+        )
+        entry.resource = self.couch
+        entry.customer = self.customer
+        self.assertEqual(entry.bookingLocks(), [
+            (BookingLock.CUSTOMER, self.customer.pk, self.date),
+            (BookingLock.RESOURCE, self.couch.pk, self.date),
+        ])
+        entry.save()
+        entry.save()
+        self.assertEqual(
+            list(BookingLock.objects.order_by('kind').values_list(
+                'kind', 'acquired',
+            )),
+            [(BookingLock.CUSTOMER, 2), (BookingLock.RESOURCE, 2)],
+        )
+        entry.cancelled = True
+        self.assertEqual(entry.bookingLocks(), [])
+
+
+class ExclusionConstraintTests(TestCase):
+    """
+    Tests of the optional database exclusion constraint backend mode.
+    """
+
+
+    def setUp(self):
+        self.couch = create_resource('couch', 'couch')
+        self.entry = create_entry(
+            datetime.date(2030, 10, 14),
+            t(10),
+            datetime.timedelta(minutes=30),
+            'constrained',
+        )
+        self.entry.resource = self.couch
+
+
+    def test_sqlite_falls_back(self):
+        """
+        SQLite has no exclusion constraints, so resources stay locked and
+        checked in the application even when the setting is on.
+        """
+        with mock.patch.object(settings, 'DIARY_DB_EXCLUSION', True):
+            self.assertEqual(
+                models.databaseExcludesClashes(),
+                connection.vendor == 'postgresql',
+            )
+            if connection.vendor != 'postgresql':
+                self.assertEqual(
+                    self.entry.bookingLocks(),
+                    [(BookingLock.RESOURCE, self.couch.pk, self.entry.date)],
+                )
+
+
+    def test_needs_constraint(self):
+        """
+        Resources stay locked unless the constraint is really there, which
+        is looked up once per connection.
+        """
+        resourceLock = (BookingLock.RESOURCE, self.couch.pk, self.entry.date)
+        with mock.patch.object(settings, 'DIARY_DB_EXCLUSION', True), \
+            mock.patch.object(connection, 'vendor', 'postgresql'), \
+            mock.patch.object(connection, 'diary_exclusion_checked', None,
+                create=True):
+            with mock.patch.object(
+                models, 'exclusionConstraintExists', return_value=False,
+            ) as exists:
+                self.assertIn(resourceLock, self.entry.bookingLocks())
+                self.assertIn(resourceLock, self.entry.bookingLocks())
+            self.assertEqual(exists.call_count, 1)
+
+            connection.diary_exclusion_checked = None  # a new connection
+            with mock.patch.object(
+                models, 'exclusionConstraintExists', return_value=True,
+            ):
+                self.assertNotIn(resourceLock, self.entry.bookingLocks())
+
+
+    def test_integrity_error_translated(self):
+        """
+        A violation of the constraint is reported as a resource clash, and
+        other integrity errors are left alone.
+        """
+        violation = IntegrityError(
+            'conflicting key value violates exclusion constraint '
+            '"{0}"'.format(models.RESOURCE_EXCLUSION_CONSTRAINT)
+        )
+        with mock.patch('django.db.models.Model.save', side_effect=violation):
+            with self.assertRaisesMessage(
+                ValidationError,
+                Entry.RESOURCE_CLASH_MESSAGE,
+            ):
+                self.entry.save()
+
+        other = IntegrityError('UNIQUE constraint failed')
+        with mock.patch('django.db.models.Model.save', side_effect=other):
+            with self.assertRaises(IntegrityError):
+                self.entry.save()
+
+
+    @unittest.skipUnless(
+        connection.vendor == 'postgresql' and settings.DIARY_DB_EXCLUSION,
+        'needs the PostgreSQL exclusion constraint',
+    )
+    def test_database_rejects_clash(self):
+        """
+        The database refuses overlapping active entries even when written
+        around the application checks.
+        """
+        self.entry.save()
+        clash = create_entry(
+            self.entry.date, t(10, 15), datetime.timedelta(minutes=30), 'clash',
+        )
+        clash.resource = self.couch
+        clash.end_time = t(10, 45)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Entry.objects.bulk_create([clash])
+        clash.cancelled = True
+        Entry.objects.bulk_create([clash])
+
+
+class EntryVersionTests(TestCase):
+    """
+    Tests of optimistic concurrency control on entries.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        self.entry = create_entry(
+            datetime.date(2030, 10, 14),
+            t(10),
+            datetime.timedelta(minutes=30),
+            'versioned',
+        )
+        self.entry.save()
+
+
+    def test_version_bumped(self):
+        """
+        New entries start at version 0 and each save bumps the version.
+        """
+        self.assertEqual(self.entry.version, 0)
+        self.entry.save()
+        self.entry.save()
+        self.assertEqual(self.entry.version, 2)
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.version, 2)
+
+
+    def test_stale_write_rejected(self):
+        """
+        The last writer doesn't silently win: a write based on an old read
+        is rejected and leaves both the row and the instance unchanged.
+        """
+        first = Entry.objects.get(pk=self.entry.pk)
+        second = Entry.objects.get(pk=self.entry.pk)
+        first.notes = 'first'
+        first.save()
+
+        second.notes = 'second'
+        with self.assertRaisesMessage(StaleEntryError, Entry.STALE_MESSAGE):
+            second.save()
+        self.assertEqual(second.version, 0)
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.notes, 'first')
+        self.assertEqual(self.entry.version, 1)
+
+
+    def test_stale_form_and_drag(self):
+        """
+        The entry form and drag-and-drop post back the version they read.
+        """
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        self.entry.save()                           # someone else's change
+        response = self.client.post(
+            reverse('diary:entry', kwargs={'pk': self.entry.pk}),
+            {
+                'date': '2030-10-14',
+                'time': '10:00',
+                'duration': '00:30',
+                'notes': 'stale',
+                'version': '0',
+            },
+        )
+        self.assertContains(response, 'changed by someone else')
+
+        with mock.patch('diary.views.fitInSlot') as fitInSlot:
+            response = self.client.post(
+                reverse('diary:entry_dnd'),
+                {
+                    'pk': self.entry.pk,
+                    'slug': '2030-10-14_11-00',
+                    'version': '0',
+                },
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'], Entry.STALE_MESSAGE)
+        fitInSlot.assert_not_called()
+        response = self.client.post(
+            reverse('diary:entry_dnd'),
+            {'pk': self.entry.pk, 'slug': '2030-10-14_11-00', 'version': '1'},
+        )
+        self.assertEqual(response.json()['version'], 2)
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.notes, 'versioned')
+
+
+    def test_update_fields(self):
+        """
+        Saving some fields still writes the new version, so later saves of
+        the same instance aren't taken for stale.
+        """
+        self.entry.save()
+        self.entry.notes = 'partial'
+        self.entry.save(update_fields=['notes'])
+        self.entry.refresh_from_db()
+        self.assertEqual((self.entry.version, self.entry.notes), (2, 'partial'))
+        self.entry.save()
+        self.assertEqual(self.entry.version, 3)
+
+
+    def test_missing_or_bad_version(self):
+        """
+        A form posted without a version saves without the check, and a
+        malformed version for drag-and-drop is refused.
+        """
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        self.entry.save()
+        response = self.client.post(
+            reverse('diary:entry', kwargs={'pk': self.entry.pk}),
+            {
+                'date': '2030-10-14',
+                'time': '10:00',
+                'duration': '00:30',
+                'notes': 'unversioned',
+                'version': '',
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        self.entry.refresh_from_db()
+        self.assertEqual(
+            (self.entry.version, self.entry.notes), (2, 'unversioned'),
+        )
+
+        response = self.client.post(
+            reverse('diary:entry_dnd'),
+            {'pk': self.entry.pk, 'slug': '2030-10-14_11-00', 'version': 'x'},
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+
+class DummySMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP to accept messages, in the manner of the
+    dummy_email_server script.
+    """
+
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost dummy')
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                for data in self.rfile:
+                    if data.rstrip(b'\r\n') == b'.':
+                        break
+                self.server.messages += 1
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                self.reply('250 ok')
+
+
+class DummySMTPServer(socketserver.ThreadingTCPServer):
+    """
+    A local SMTP stand-in counting the connections and messages it gets.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+    def __init__(self):
+        super().__init__(('localhost', 0), DummySMTPHandler)
+        self.connections = self.messages = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+
+class OutboxTests(TestCase):
+    """
+    Tests of the outbound email queue and its worker.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        for n in range(5):
+            outbox.enqueue(
+                'subject {0}'.format(n),
+                'body',
+                'diary@example.com',
+                ['one@example.com', 'two@example.com'],
+            )
+        self.now = timezone.now()
+
+
+    def test_change_notification_queued(self):
+        """
+        Request handlers only queue their notification emails.
+        """
+        OutboundEmail.objects.all().delete()
+        customer = create_customer('customer')
+        entry = create_entry(
+            datetime.date(2030, 10, 14), t(10),
+            datetime.timedelta(minutes=30), 'notified',
+        )
+        entry.customer = customer
+        entry.save()
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        self.client.post(
+            reverse('diary:entry_dnd'),
+            {'pk': entry.pk, 'slug': '2030-10-14_11-00'},
+        )
+        self.assertEqual(len(mail.outbox), 0)
+        queued = OutboundEmail.objects.get()
+        self.assertIn('customer@example.com', queued.recipient_list())
+        self.assertIsNone(queued.sent)
+
+
+    def test_one_smtp_connection(self):
+        """
+        The queue is drained in batches over one connection to the server.
+        """
+        server = DummySMTPServer()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with self.settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='localhost',
+            EMAIL_PORT=server.server_address[1],
+        ):
+            self.assertEqual(outbox.send_queued(batch_size=2), (5, 0))
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(server.messages, 5)
+        self.assertFalse(OutboundEmail.objects.filter(sent__isnull=True))
+
+
+    def test_retry_with_backoff(self):
+        """
+        Failures are rescheduled with exponential backoff, then given up.
+        """
+        failing = mock.patch(
+            'django.core.mail.backends.locmem.EmailBackend.send_messages',
+            side_effect=OSError('server down'),
+        )
+        with failing:
+            self.assertEqual(outbox.send_queued(now=self.now), (0, 5))
+        email = OutboundEmail.objects.first()
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.next_attempt, self.now + settings.DIARY_EMAIL_BACKOFF)
+        self.assertIn('server down', email.last_error)
+
+        # nothing is due again until the backoff has passed
+        self.assertEqual(outbox.send_queued(now=self.now), (0, 0))
+        later = self.now + settings.DIARY_EMAIL_BACKOFF
+        with failing:
+            self.assertEqual(outbox.send_queued(now=later), (0, 5))
+        email.refresh_from_db()
+        self.assertEqual(
+            email.next_attempt,
+            later + 2 * settings.DIARY_EMAIL_BACKOFF,
+        )
+
+        # emails are given up after the maximum attempts
+        OutboundEmail.objects.filter(pk=email.pk).update(
+            attempts=settings.DIARY_EMAIL_ATTEMPTS,
+        )
+        much_later = self.now + datetime.timedelta(days=1)
+        self.assertEqual(outbox.send_queued(now=much_later), (4, 0))
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(mail.outbox[0].to, ['one@example.com', 'two@example.com'])
+
+
+    def test_concurrent_drains(self):
+        """
+        Drains running at the same time never send the same email twice.
+        """
+        send_messages = locmem.EmailBackend.send_messages
+        drains = []
+
+        def sendDuringOtherDrain(backend, messages):
+            if not drains:
+                # another worker drains the queue while the first email sends
+                drains.append(None)
+                drains[0] = outbox.send_queued(now=self.now)
+            return send_messages(backend, messages)
+
+        with mock.patch.object(
+            locmem.EmailBackend, 'send_messages', sendDuringOtherDrain,
+        ):
+            self.assertEqual(outbox.send_queued(now=self.now), (1, 0))
+        self.assertEqual(drains, [(4, 0)])
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(
+            sorted(message.subject for message in mail.outbox),
+            ['subject {0}'.format(n) for n in range(5)],
+        )
+
+
+    def test_handlers_queue_with_change(self):
+        """
+        A change that fails queues no notification.
+        """
+        OutboundEmail.objects.all().delete()
+        customer = create_customer('customer')
+        entry = create_entry(
+            datetime.date(2030, 10, 14), t(10),
+            datetime.timedelta(minutes=30), 'notified',
+        )
+        entry.customer = customer
+        entry.save()
+        self.client.force_login(obtain_superuser(), backend=MODEL_BACKEND)
+        with mock.patch.object(
+            outbox, 'enqueue', side_effect=OSError('no queue'),
+        ), self.assertRaises(OSError):
+            self.client.post(
+                reverse('diary:entry_dnd'),
+                {'pk': entry.pk, 'slug': '2030-10-14_11-00'},
+            )
+        entry.refresh_from_db()
+        self.assertEqual(entry.time, t(10))
+
+
+    def test_command(self):
+        """
+        The worker command drains the queue.
+        """
+        call_command('send_queued_email', batch=2)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(OutboundEmail.objects.filter(sent__isnull=True))
+
+
+class EmailReminderTests(TestCase):
+    """
+    Tests of the batched email reminder pipeline.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        self.tomorrow = datetime.date(2015, 10, 13)
+        self.treatment = create_treatment('massage', datetime.timedelta(0), False)
+        for n in range(5):
+            customer = Customer.objects.create(
+                username='customer{0}'.format(n),
+                email='customer{0}@example.com'.format(n),
+                password='random',
+            )
+            entry = create_entry(
+                self.tomorrow, t(9 + n), datetime.timedelta(hours=1), 'due',
+            )
+            entry.customer = customer
+            entry.treatment = self.treatment
+            entry.save()
+        cancelled = create_entry(
+            self.tomorrow, t(16), datetime.timedelta(hours=1), 'cancelled',
+        )
+        cancelled.customer = customer
+        cancelled.cancelled = True
+        cancelled.save()
+
+
+    def due(self):
+        """
+        The entries due a day reminder, with a window covering tomorrow.
+        """
+        return reminders.due(
+            'day',
+            datetime.datetime(2015, 10, 12, 12),
+            datetime.datetime(2015, 10, 13, 23),
+        )
+
+
+    def test_no_n_plus_one(self):
+        """
+        Entries stream with their customers from one query, fetched in
+        chunks, and each reminder only costs its claim in the ledger.
+        """
+        with self.assertNumQueries(1 + 5 * 3):      # entries + 5 claims
+            sent, failed = reminders.send_reminders(
+                'day',
+                self.due(),
+                batch_size=2,
+            )
+        self.assertEqual((len(sent), len(failed)), (5, 0))
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ['customer{0}@example.com'.format(n) for n in range(5)],
+        )
+
+
+    def test_partial_failure_resumes(self):
+        """
+        A failed reminder doesn't stop the run, and repeating the run only
+        sends the reminders not yet sent.
+        """
+        send_messages = mail.get_connection().__class__.send_messages
+        calls = []
+
+        def flaky(connection, messages):
+            calls.append(messages[0].to[0])
+            if len(calls) == 2:
+                raise OSError('server hiccup')
+            return send_messages(connection, messages)
+
+        with mock.patch(
+            'django.core.mail.backends.locmem.EmailBackend.send_messages',
+            flaky,
+        ):
+            sent, failed = reminders.send_reminders(
+                'day',
+                self.due(),
+                batch_size=2,
+            )
+        self.assertEqual((len(sent), len(failed)), (4, 1))
+        self.assertIn('server hiccup', failed[0])
+        self.assertEqual(SentReminder.objects.count(), 4)
+
+        mail.outbox = []
+        sent, failed = reminders.send_reminders('day', self.due())
+        self.assertEqual((len(sent), len(failed)), (1, 0))
+        self.assertEqual([message.to for message in mail.outbox], [[calls[1]]])
+
+
+    def test_claimed_elsewhere(self):
+        """
+        A reminder claimed by an overlapping run after the entries were
+        fetched isn't sent again.
+        """
+        chunked = reminders.chunked
+
+        def raced(entries, size):
+            for chunk in chunked(entries, size):
+                reminders.claim('day', chunk[0])
+                yield chunk
+
+        with mock.patch('diary.reminders.chunked', raced):
+            sent, failed = reminders.send_reminders(
+                'day',
+                self.due(),
+                batch_size=2,
+            )
+        self.assertEqual((len(sent), len(failed)), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(SentReminder.objects.count(), 5)
+
+
+    @freeze_time('2015-10-12 12:00:00')
+    def test_command(self):
+        """
+        The command sends the reminders and a summary for the admins, and
+        sends nothing twice, not even a summary.
+        """
+        call_command('email_reminder', batch=2, workers=2)
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertIn('Reminders sent to 5 customers', mail.outbox[-1].body)
+        call_command('email_reminder')
+        self.assertEqual(len(mail.outbox), 6)
+
+
+    def test_windows(self):
+        """
+        Rule windows run back-to-back from now, shortest lead first.
+        """
+        now = datetime.datetime(2015, 10, 12, 12)
+        hours = lambda n: datetime.timedelta(hours=n)
+        self.assertEqual(
+            reminders.windows(now, {'day': hours(24), 'soon': hours(2)}),
+            [
+                ('soon', now, now + hours(2)),
+                ('day', now + hours(2), now + hours(24)),
+            ],
+        )
+
+
+    def test_rules_and_versions(self):
+        """
+        Each rule reminds of entries as they enter its window, and reminds
+        again when an entry changes.
+        """
+        rules = {
+            'day': datetime.timedelta(hours=24),
+            'soon': datetime.timedelta(hours=2),
+        }
+        with mock.patch.object(settings, 'DIARY_REMINDER_RULES', rules):
+
+            # 13:00 local: every entry tomorrow is in the day window
+            with freeze_time('2015-10-12 12:00:00'):
+                call_command('email_reminder')
+            self.assertEqual(SentReminder.objects.filter(rule='day').count(), 5)
+
+            # 08:30 local tomorrow: the 09:00 and 10:00 entries are soon
+            with freeze_time('2015-10-13 07:30:00'):
+                call_command('email_reminder')
+                call_command('email_reminder')
+            self.assertEqual(
+                sorted(SentReminder.objects.filter(
+                    rule='soon',
+                ).values_list('entry__time', flat=True)),
+                [t(9), t(10)],
+            )
+
+            # a changed entry is reminded of again
+            entry = Entry.objects.get(date=self.tomorrow, time=t(10))
+            entry.notes = 'changed'
+            entry.save()
+            mail.outbox = []
+            with freeze_time('2015-10-13 07:30:00'):
+                call_command('email_reminder')
+            self.assertEqual(
+                [message.to for message in mail.outbox[:-1]],
+                [[entry.customer.email]],
+            )
+
+
+    def test_starting_between(self):
+        """
+        Windows can span midnight and more than one day.
+        """
+        entries = Entry.objects.order_by('time')
+        self.assertEqual(
+            entries.starting_between(
+                datetime.datetime(2015, 10, 12, 23),
+                datetime.datetime(2015, 10, 13, 10),
+            ).count(),
+            2,                                      # 09:00 and 10:00
+        )
+        self.assertEqual(
+            entries.starting_between(
+                datetime.datetime(2015, 10, 11, 12),
+                datetime.datetime(2015, 10, 14, 12),
+            ).count(),
+            6,
+        )
+        self.assertEqual(
+            entries.starting_between(
+                datetime.datetime(2015, 10, 13, 10),
+                datetime.datetime(2015, 10, 13, 12),
+            ).count(),
+            2,                                      # 11:00 and 12:00
+        )
+
+
+class FakeClock(object):
+    """
+    A clock for the scheduler whose sleeps pass instantly.
+    """
+
+
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+
+    def __call__(self):
+        return self.now
+
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += datetime.timedelta(seconds=seconds)
+
+
+
+class SchedulerTests(TestCase):
+    """
+    Tests of the resident scheduler, run against a fake clock.
+    """
+
+
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock(datetime.datetime(2015, 10, 12, 13))
+
+        # a test case's connection is in a transaction, which looks obsolete
+        patcher = mock.patch('diary.scheduler.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.minute = datetime.timedelta(minutes=1)
+
+
+    def scheduler(self):
+        return scheduler.Scheduler(
+            clock=self.clock,
+            sleep=self.clock.sleep,
+            poll=10 * self.minute,
+        )
+
+
+    def test_jobs_run_in_time_order(self):
+        """
+        Jobs run as they fall due, and the scheduler sleeps until the next
+        one, or the poll interval at most.
+        """
+        runs = []
+
+        def job(name, every):
+            def run(now):
+                runs.append((name, now.time()))
+                return now + every if len(runs) < 6 else None
+            return run
+
+        jobs = self.scheduler()
+        jobs.schedule(self.clock.now + 3 * self.minute, job('a', 4 * self.minute))
+        jobs.schedule(self.clock.now + 5 * self.minute, job('b', 30 * self.minute))
+        jobs.run(cycles=7)
+        self.assertEqual(runs, [
+            ('a', t(13, 3)),
+            ('b', t(13, 5)),
+            ('a', t(13, 7)),
+            ('a', t(13, 11)),
+            ('a', t(13, 15)),
+            ('a', t(13, 19)),
+        ])
+        self.assertEqual(self.clock.sleeps[:2], [180, 120])
+        self.assertEqual(max(self.clock.sleeps), 600)   # the poll interval
+
+
+    def test_failing_job_retried(self):
+        """
+        A failing job is logged and retried after the poll interval.
+        """
+        runs = []
+
+        def broken(now):
+            runs.append(now)
+            raise OSError('oops')
+
+        jobs = self.scheduler()
+        jobs.schedule(self.clock.now, broken)
+        with self.assertLogs('diary.scheduler', 'ERROR') as logs:
+            jobs.run(cycles=2)
+        self.assertEqual(runs[1] - runs[0], 10 * self.minute)
+        self.assertIn('Scheduled job broken failed', logs.output[0])
+        self.assertIn("OSError: oops", logs.output[0])   # with traceback
+
+
+    def test_reminders_wake_on_next_deadline(self):
+        """
+        The reminder job wakes when the next entry enters a reminder window,
+        and sends its reminder then.
+        """
+        customer = create_customer('customer')
+        entry = create_entry(
+            datetime.date(2015, 10, 13), t(13, 4),
+            datetime.timedelta(hours=1), 'tomorrow',
+        )
+        entry.customer = customer
+        entry.save()
+
+        with mock.patch.object(
+            settings, 'DIARY_SCHEDULER_POLL', 10 * self.minute,
+        ):
+            self.assertEqual(
+                scheduler.send_reminders(self.clock.now),
+                self.clock.now + 4 * self.minute,
+            )
+            self.assertEqual(len(mail.outbox), 0)
+
+            jobs = scheduler.diary_scheduler(
+                clock=self.clock,
+                sleep=self.clock.sleep,
+            )
+            jobs.run(cycles=2)
+        self.assertEqual(self.clock.sleeps[0], 4 * 60)
+        self.assertEqual(mail.outbox[0].to, [customer.email])
+        self.assertEqual(
+            SentReminder.objects.get().entry_id,
+            entry.pk,
+        )
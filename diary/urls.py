@@ -80,6 +80,13 @@ urlpatterns = [
     url(r'^entry_modal/(?P<pk>\d+)/$', views.entry_modal, name='entry_modal',),
 
 
+    # availability search with json results
+    url(r'^availability/(?P<treatment_pk>\d+)/$',
+        views.availability,
+        name='availability',
+    ),
+
+
     # customer administration - overrides admin pages to control redirection
     url(r'^customer_add/(?P<entry_pk>\d+)/$',
         views.customer_add,
@@ -113,5 +120,9 @@ urlpatterns = [
         views.history,
         name='history_default',                     # default is current user
     ),
+    url(r'^history/(?P<pk>\d+)/entries/$',
+        views.history_entries,
+        name='history_entries',                     # further history as json
+    ),
 
 ]
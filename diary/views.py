@@ -10,18 +10,26 @@ import calendar
 from django.template.context_processors import csrf
 from django.http import HttpResponseRedirect, JsonResponse, HttpResponse
 from django.urls import reverse
-from django.db.models import Q
+from django.db.models import QuerySet
+from django.db import transaction
 from django.forms import ValidationError
 from django.template.loader import render_to_string
 from django.template import RequestContext
-from django.core import mail
 from django.conf import settings as main_settings
 
 
 # Create your views here.
 
-from .models import Entry, Customer
+from .models import (
+    Entry, HistoricEntry, Customer, Treatment, StaleEntryError,
+)
 from .forms import EntryForm
+from .grid import DiaryGrid
+from .availability import availability as find_availability
+from .intervals import Occupancy
+from . import caching
+from . import historic
+from . import outbox
 from .admin import CustomerCreationForm, CustomerChangeForm
 from . import settings
 
@@ -74,18 +82,34 @@ class Statistics(object):
 
 
 
-def get_statistics(entries):
+def entryCounts(entries):
+    """
+    Count the total, cancelled and no-show entries in a queryset, in the
+    database, or in a list.
+    """
+    if isinstance(entries, QuerySet):
+        return entries.statistics()
+    return {
+        'total': len(entries),
+        'cancelled': sum(1 for entry in entries if entry.cancelled),
+        'no_show': sum(1 for entry in entries if entry.no_show),
+    }
+
+
+def get_statistics(*entry_sets):
     """
-    Derive the statistics for a queryset or list of entries.
+    Derive the statistics for one or more querysets or lists of entries
+    taken together. Querysets are counted by the database.
     """
-    total = len(entries)
+    counts = [entryCounts(entries) for entries in entry_sets]
+    total = sum(count['total'] for count in counts)
 
     if total:
-        cancelled = no_show = 0
-        for entry in entries:
-            if entry.cancelled: cancelled += 1
-            if entry.no_show: no_show += 1
-        return Statistics(total, cancelled, no_show)
+        return Statistics(
+            total,
+            sum(count['cancelled'] for count in counts),
+            sum(count['no_show'] for count in counts),
+        )
     else:
         return None
 
@@ -125,41 +149,28 @@ def get_today_now():
     return today, now
 
 
+def yearsBefore(date, years):
+    """
+    The same day the given number of years before the date, taking 29th
+    February back to the 28th in years without one.
+    """
+    try:
+        return date.replace(year=date.year-years)
+    except ValueError:
+        return date.replace(year=date.year-years, day=28)
+
+
 
 def reminders(request):
     """
     Data for the reminder sidebar.
     """
 
-    today, now = get_today_now()
-    tomorrow = today + datetime.timedelta(days=1)
-
-    # get the customer corresponding to the user unless user is staff
-    if request.user.is_authenticated: # skip for anonymous users
-        customer = (
-            Customer.objects.get(
-                username=request.user.username,
-            ) if not request.user.is_staff
-            else (
-                request.user
-            )
-        )
-        queryset = (
-            Entry.objects.filter(          # admin/staff users see everything
-                Q(date=today, time__gte=now)|Q(date=tomorrow),
-                cancelled=False,
-            ) if request.user.is_staff
-            else
-            Entry.objects.filter(          # customers only see their own entries
-                Q(date=today, time__gte=now)|Q(date=tomorrow),
-                customer=customer,
-                cancelled=False,
-            )
-        )
-        return queryset.order_by('date', 'time')
+    # anonymous users have no reminders
+    if not request.user.is_authenticated:
+        return []
 
-    # anonymour user so queryset is empty
-    return []
+    return caching.reminders(request.user)
 
 
 
@@ -175,13 +186,12 @@ def year(request, year=None):
     else:
         year = now.year
 
+    occupied = caching.occupancy(year-1, year+1)
     years = []
     for yr in [year-1, year, year+1,]:
         months = []
         for n, month in enumerate(MONTH_NAMES):
-            entries = Entry.objects.filter(date__year=yr, date__month=n+1)
-            entry = (True if entries
-                else False)
+            entry = bool(occupied[yr] & (1 << n))
             current = (True if (yr == now.year) and (n == now.month-1)
                 else False)
             months.append({
@@ -232,24 +242,51 @@ def month(request, year=None, month=None, change=None):
     weeks = [[]]
     week_no = 0
 
+    # staff see the statistics for the whole month from one grouped query
+    # each on recent and historic entries, customers see their own recent
+    # and historic entries for the month from one query each
+    month_start = date.replace(day=1)
+    month_end = date.replace(day=calendar.monthrange(date.year, date.month)[1])
+    if request.user.is_staff:
+        daily_statistics = {}
+        for model in (Entry, HistoricEntry):
+            for dayDate, counts in model.objects.filter(
+                date__gte=month_start,
+                date__lte=month_end,
+            ).daily_statistics().items():
+                totals = daily_statistics.setdefault(
+                    dayDate, dict.fromkeys(counts, 0),
+                )
+                for name, count in counts.items():
+                    totals[name] += count
+    else:
+        entries = []
+        for model in (Entry, HistoricEntry):
+            entries += model.objects.filter(
+                date__gte=month_start,
+                date__lte=month_end,
+                customer=request.user,
+                cancelled=False,
+            ).select_related(
+                'customer',
+                'treatment',
+                'resource',
+            )
+        daily_entries = {}
+        for entry in sorted(entries, key=historic.entryKey):
+            daily_entries.setdefault(entry.date, []).append(entry)
+
     # process all the days in the month
     for day in month_days:
         entry_list = statistics = current = None
         nav_slug = None
         if day:
             dayDate = datetime.date(year=date.year, month=date.month, day=day)
-            entries = (
-                Entry.objects.filter(date=dayDate) if request.user.is_staff
-                else Entry.objects.filter(
-                    date=dayDate,
-                    customer=request.user,
-                    cancelled=False,
-                )
-            )
             if request.user.is_staff:
-                statistics = get_statistics(entries)
+                counts = daily_statistics.get(dayDate)
+                statistics = Statistics(**counts) if counts else None
             else:
-                entry_list = list(entries)
+                entry_list = daily_entries.get(dayDate, [])
 
             nav_slug = dayDate.strftime(DATE_SLUG_FORMAT)
             current = (dayDate == today)
@@ -325,28 +362,6 @@ def getDatetimeFromSlug(slug):
     return date_time.date(), date_time.time()
 
 
-def evaluateBusinessLogic(day, startTime, endTime):
-    """
-    Evaluate the booleans that control the display business logic for day and
-    multi-day views.
-    """
-    today, now = get_today_now()
-    current = ((now >= startTime and now < endTime) and day == today)
-    trading = (
-        startTime >= settings.DIARY_OPENING_TIMES[day.weekday()] and
-        endTime <= settings.DIARY_CLOSING_TIMES[day.weekday()]
-    ) # trading time
-    historic = (
-        day < today or (day == today and endTime < now)
-    ) # historic data
-    booking_allowed_date = (today +
-        datetime.timedelta(days=settings.DIARY_MIN_BOOKING)
-    )
-    before_advance = day < booking_allowed_date
-    allow_dnd = trading and not (historic or before_advance)
-    return current, trading, historic, before_advance, allow_dnd
-
-
 @login_required
 def multi_day(request, slug=None, change=None):
     """
@@ -374,32 +389,27 @@ def multi_day(request, slug=None, change=None):
     nav_slug = date_slots[0][0].strftime(DATE_SLUG_FORMAT)
 
     # obtain the days' entries divided into time slots
+    grid = DiaryGrid(
+        date,
+        settings.DIARY_MULTI_DAY_NUMBER,
+        TIME_SLOTS,
+        request.user,
+    )
+
     # rows represent times...
     time_slots = []
-    for timeLabel, time_slug, startTime, endTime in TIME_SLOTS:
+    for (timeLabel, time_slug, startTime, endTime), cells in grid:
         # cols represent days...
         day_entries = []
-        for day, dayHeader, date_slug in date_slots:
-            entries = (
-                Entry.objects.filter(
-                    date=day,
-                    time__gte=startTime,
-                    time__lt=endTime,
-                )
-            ).order_by('time')
-
-            # evaluate the business rules for entry booking
-            current, trading_time, historic, before_advance, allow_dnd =\
-                evaluateBusinessLogic(day, startTime, endTime)
-
+        for (day, dayHeader, date_slug), cell in zip(date_slots, cells):
             day_entries.append((
                 '_'.join((date_slug, time_slug)), # date-time slug
-                entries, # the entries
-                current, # now
-                trading_time, # trading time
-                historic, # historic data
-                before_advance, # before advance booking threshold
-                allow_dnd, # allow drag-n-drop
+                cell.entries, # the entries
+                cell.current, # now
+                cell.trading, # trading time
+                cell.historic, # historic data
+                cell.before_advance, # before advance booking threshold
+                cell.allow_dnd, # allow drag-n-drop
             ))
         time_slots.append((
             timeLabel,
@@ -435,30 +445,19 @@ def day(request, slug=None, change=None):
     date_slug = date.strftime(DATE_SLUG_FORMAT)
 
     # obtain the day's entries divided into time slots
+    grid = DiaryGrid(date, 1, TIME_SLOTS, request.user)
     time_slots = []
-    for timeLabel, time_slug, startTime, endTime in TIME_SLOTS:
-        entries = (
-            Entry.objects.filter(
-                date=date,
-                time__gte=startTime,
-                time__lt=endTime,
-            )
-        ).order_by('time')
-
-        # evaluate the business rules for entry booking
-        current, trading_time, historic, before_advance, allow_dnd =\
-            evaluateBusinessLogic(date, startTime, endTime)
-
+    for (timeLabel, time_slug, startTime, endTime), (cell,) in grid:
         time_slots.append((
             timeLabel,
             '_'.join((date_slug, time_slug)),
             startTime,
-            entries,
-            current, # flag now
-            trading_time, # trading
-            historic, # historic data
-            before_advance, # advance booking prohibited
-            allow_dnd,
+            cell.entries,
+            cell.current, # flag now
+            cell.trading, # trading
+            cell.historic, # historic data
+            cell.before_advance, # advance booking prohibited
+            cell.allow_dnd,
         ))
 
     return render(
@@ -527,7 +526,8 @@ def email_notify_entry_change(entry, header_text, body_text_filename, context):
     if entry.customer.email and not entry.customer.opt_out_entry_change_email:
         recipients.append(entry.customer.email)
 
-    mail.send_mail(
+    # queue the email rather than wait for the mail server
+    outbox.enqueue(
         settings.DIARY_SITE_NAME+header_text.format(entry.customer),
         render_to_string(
             body_text_filename,
@@ -535,7 +535,7 @@ def email_notify_entry_change(entry, header_text, body_text_filename, context):
         ),
         main_settings.DEFAULT_FROM_EMAIL,
         recipients,
-            )
+    )
 
 
 
@@ -585,17 +585,20 @@ def entry(request, pk=None, slug=None, customer_pk=None):
     )
     if form.is_valid():
         entry = form.save(commit=False)
-        entry.save()
-
-        # notify changes by email
-        email_notify_entry_change(
-            entry,
-            ': New Diary Entry for {}',
-            'diary/email_notify_new_entry.txt',
-            {'entry': entry,},
-        )
-
-        return redirect(next_url)
+        try:
+            # queue the notification with the change, or not at all
+            with transaction.atomic():
+                entry.save()
+                email_notify_entry_change(
+                    entry,
+                    ': New Diary Entry for {}',
+                    'diary/email_notify_new_entry.txt',
+                    {'entry': entry,},
+                )
+        except ValidationError as ve:
+            form.add_error(None, ve)    # e.g. changed by someone else
+        else:
+            return redirect(next_url)
 
     # have to set up the customer widget after form creation
     if not exclude_customer:
@@ -631,6 +634,30 @@ def entry(request, pk=None, slug=None, customer_pk=None):
     )
 
 
+def fitInSlot(entry, date, time):
+    """
+    Find the first gap in the time slot starting at date and time that fits
+    the entry around the bookings of its resource and customer.
+
+    Returns the start time of the gap, or None if the slot has no such gap
+    later than time itself. The gaps are found from one query.
+    """
+    if not (entry.resource_id or entry.customer_id):
+        return None                 # no bookings the entry could clash with
+    slotEnd = datetime.datetime.combine(date, time) + settings.DIARY_TIME_INC
+    if slotEnd.date() != date:
+        return None
+    gap = Occupancy.for_day(
+        date,
+        resource=entry.resource_id,
+        customer=entry.customer_id,
+        exclude=entry,
+    ).next_gap(time, entry.duration_delta())
+    if gap is None or gap <= time or gap >= slotEnd.time():
+        return None
+    return gap
+
+
 @login_required
 def entry_update(request):
     """
@@ -657,44 +684,111 @@ def entry_update(request):
     entry.no_show = False
     entry.cancelled = False
 
+    # reject drags of an entry changed since the page was displayed
+    if request.POST.get('version'):
+        try:
+            entry.version = int(request.POST['version'])
+        except ValueError:
+            return JsonResponse({'message': 'Invalid entry version.'}, status=400)
+
     try:
-        entry.save()
+        with transaction.atomic():
+            try:
+                entry.save()
+            except StaleEntryError:
+                raise               # moving it elsewhere won't help
+            except ValidationError:
+                # attempt to fit the entry in the first gap later in the slot
+                fittedTime = fitInSlot(entry, date, time)
+                if fittedTime is None:
+                    raise
+                entry.time = fittedTime
+                entry.save()
+
+            # notify changes by email, queued with the change
+            email_notify_entry_change(
+                entry,
+                ': Diary Entry Change for {}',
+                'diary/email_notify_entry_change.txt',
+                {
+                    'entry': entry,
+                    'old_entry_date': old_entry_date,
+                    'old_entry_time': old_entry_time,
+                },
+            )
     except ValidationError as ve:
-        # attempt to fit the entry in later in the time slot
-        endTime = (
-            datetime.datetime.combine(date, time) + DIARY_TIME_INC
-            ).time()
-        otherEntry = Entry.objects\
-            .filter(
-                date=date,
-                time__gte=time,
-                time__lt=endTime,
-            ).first()
-        if otherEntry.time_end() >= endTime:
-            # really no more space in this time slot
-            raise ve
-        # try adding after the other entry
-        entry.time = otherEntry.time_end()
-        entry.save()
-
-    # notify changes by email
-    email_notify_entry_change(
-        entry,
-        ': Diary Entry Change for {}',
-        'diary/email_notify_entry_change.txt',
-        {
-            'entry': entry,
-            'old_entry_date': old_entry_date,
-            'old_entry_time': old_entry_time,
-        },
-    )
+        return JsonResponse({'message': ' '.join(ve.messages)}, status=400)
 
     message = 'Date / time changed to {0}, {1}'.format(entry.date, entry.time)
-    data = {'message': message}
+    data = {'message': message, 'version': entry.version}
     #print('Sending entry_update data {0}'.format(data))
     return JsonResponse(data)
 
 
+@login_required
+def availability(request, treatment_pk):
+    """
+    Send the free windows for a treatment as json.
+
+    The optional GET parameters 'start' and 'end' are date slugs for the
+    range searched, by default DIARY_AVAILABILITY_DAYS from today. Staff may
+    name a 'customer' pk to keep clear of their bookings. Customers only see
+    windows they are allowed to book, clear of their own bookings.
+    """
+
+    treatment = get_object_or_404(Treatment, pk=treatment_pk)
+    maxDays = datetime.timedelta(days=settings.DIARY_AVAILABILITY_DAYS)
+    try:
+        start = getDateFromSlug(request.GET.get('start'), None)
+        end = request.GET.get('end')
+        if end:
+            end = getDateFromSlug(end, None)
+        else:
+            end = start + maxDays - datetime.timedelta(days=1)
+    except ValueError:
+        return JsonResponse({'error': 'Dates must be YYYY-MM-DD.'}, status=400)
+    if end < start or end - start >= maxDays:
+        return JsonResponse(
+            {'error': 'Search at most {0} days.'.format(maxDays.days)},
+            status=400,
+        )
+
+    after = None
+    if request.user.is_staff:
+        customer = None
+        if request.GET.get('customer'):
+            customer = get_object_or_404(Customer, pk=request.GET['customer'])
+    else:
+        customer = request.user
+        today, now = get_today_now()
+        if settings.DIARY_MIN_BOOKING:
+            after = datetime.datetime.combine(
+                today + datetime.timedelta(days=settings.DIARY_MIN_BOOKING),
+                datetime.time.min,
+            )
+        else:
+            after = datetime.datetime.combine(today, now)
+
+    duration = treatment.min_duration or datetime.timedelta(0)
+    data = {
+        'treatment': treatment.pk,
+        'duration': int(duration.total_seconds()) // 60,
+        'windows': [
+            {
+                'date': window.date.strftime(DATE_SLUG_FORMAT),
+                'start': window.start.strftime(TIME_SLUG_FORMAT),
+                'end': window.end.strftime(TIME_SLUG_FORMAT),
+                'resource': window.resource.pk if window.resource else None,
+                'resource_name': str(window.resource or ''),
+            }
+            for window in find_availability(
+                treatment, start, end, customer=customer, after=after,
+            )
+        ],
+    }
+    return JsonResponse(data)
+
+
 @login_required
 def entry_modal(request, pk):
     """
@@ -772,24 +866,25 @@ def entry_admin(request, pk, action):
     entry = get_object_or_404(Entry, pk=pk)
     date = entry.date
 
-    if action == 'delete':
-        entry.delete()
-    else:
-        entry.cancelled = (action == 'cancel')
-        entry.no_show = (action == 'no_show')
-        entry.editor = request.user
-        entry.save()
-
-    # notify entry status change by email
-    email_notify_entry_change(
-        entry,
-        ': Diary Entry Status Change for {}',
-        'diary/email_notify_entry_status_change.txt',
-        {
-            'entry': entry,
-            'status': action,
-        },
-    )
+    with transaction.atomic():
+        if action == 'delete':
+            entry.delete()
+        else:
+            entry.cancelled = (action == 'cancel')
+            entry.no_show = (action == 'no_show')
+            entry.editor = request.user
+            entry.save()
+
+        # notify entry status change by email, queued with the change
+        email_notify_entry_change(
+            entry,
+            ': Diary Entry Status Change for {}',
+            'diary/email_notify_entry_status_change.txt',
+            {
+                'entry': entry,
+                'status': action,
+            },
+        )
 
     return redirect(
         redirect_url,
@@ -903,30 +998,73 @@ def customer_change(request, pk=None):
     )
 
 
+def historyCursor(key):
+    """
+    The history page cursor for a (date, time, pk) key.
+    """
+    date, time, pk = key
+    return '{0}_{1}_{2}'.format(date.isoformat(), time.isoformat(), pk)
+
+
+def getHistoryCursor(cursor):
+    """
+    The (date, time, pk) key of a history page cursor, or None if there is
+    none. Raises ValueError if the cursor is malformed.
+    """
+    if not cursor:
+        return None
+    date, time, pk = cursor.split('_')
+    return (
+        datetime.date.fromisoformat(date),
+        datetime.time.fromisoformat(time),
+        int(pk),
+    )
+
+
+def historyPage(customer, before=None):
+    """
+    A page of the customer's history up to today, most recent first, and the
+    url of the next page, or None at the end.
+    """
+    today, now = get_today_now()
+    entries, key = historic.customer_page(
+        customer,
+        today,
+        settings.DIARY_HISTORY_PAGE,
+        before,
+    )
+    next_page = None
+    if key:
+        next_page = '{0}?before={1}'.format(
+            reverse('diary:history_entries', kwargs={'pk': customer.pk}),
+            historyCursor(key),
+        )
+    return entries, next_page
+
+
 @login_required
 def history(request, pk):
     """
     Review a customer's treatment history.
+
+    The first page of entries is shown, and the rest are fetched by
+    history_entries as the page is scrolled.
     """
 
     customer, redirect_url = get_customer_and_redirect(request, pk)
 
-    # get the relevant entries
-    today, now = get_today_now()
-    entries = list(
-        Entry.objects.filter(
-            customer=customer,
-            date__lte=today,
-        ).order_by('date', 'time')
-    )
+    # get the most recent entries, recent and historic
+    entries, next_page = historyPage(customer)
 
-    # some arithmetic
-    statistics = get_statistics(entries)
+    # some arithmetic over the whole history, done by the database
+    today, now = get_today_now()
+    statistics = get_statistics(*historic.customer_querysets(customer, today))
 
     context = {
         'next': redirect_url,
         'customer': customer,
         'entries': entries,
+        'next_page': next_page,
         'statistics': statistics,
         'reminders': reminders(request),
     }
@@ -936,3 +1074,32 @@ def history(request, pk):
         'diary/history.html',
         context,
     )
+
+
+@login_required
+def history_entries(request, pk=None):
+    """
+    Send the next page of a customer's treatment history as json, for
+    infinite scrolling.
+
+    The GET parameter 'before' is the cursor from the previous page's next
+    url. The response holds the rendered rows and the url of the page after,
+    or null at the end.
+    """
+
+    customer, redirect_url = get_customer_and_redirect(request, pk)
+    try:
+        before = getHistoryCursor(request.GET.get('before'))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid history cursor.'}, status=400)
+
+    entries, next_page = historyPage(customer, before)
+    data = {
+        'html': render_to_string(
+            'diary/history_rows.html',
+            {'entries': entries},
+            request=request,
+        ),
+        'next': next_page,
+    }
+    return JsonResponse(data)